@@ -18,6 +18,15 @@ lidar_data_column = 'lidar_data'
 steer_suggestion_column = 'steer_suggestion'
 actual_steer_column = 'actual_steer'
 time_column = 'time_taken'
+suggested_steer_column = 'suggested_steer'
+difference_column = 'difference'
+model_column = 'model'
+
+# Value used when a suggestion contains no number
+missing_steer = 99999
+# First signed decimal number in a suggestion, e.g. "-0.25" in "steer: -0.25 to the left"
+steer_pattern = r'([-+]?\d+(?:\.\d+)?)'
+steer_suffix = 'steer_suggestion2.1.csv'
 
 prompt = ("Extract the number value from the following prompt, if the value is not present, please output 99999. "
           "Make sure to only output a number and nothing else:  ")
@@ -37,15 +46,25 @@ def load_dataframe(file_path):
 def extract_steer(steer_suggestion):
     import re
     # Using regular expression to find a number in the string
-    match = re.search(r'\d+', str(steer_suggestion))
+    match = re.search(steer_pattern, str(steer_suggestion))
     if match:
-        return int(match.group())  # Extracted number
+        return float(match.group())  # Extracted number
     else:
-        return 99999  # Return 99999 if no number is found
-
-
+        return missing_steer  # Return 99999 if no number is found
 
 
+# Parse the suggested steer of every row at once and return a copy of the dataframe with it, and its difference
+# to the actual steer, as columns. The caller's dataframe is left unchanged. A dataframe that already has
+# the columns, e.g. one returned by load_results, is returned as is, so the suggestions are parsed only once.
+def add_steer_columns(dataframe):
+    if suggested_steer_column in dataframe.columns and difference_column in dataframe.columns:
+        return dataframe
+    suggested_steer = (dataframe[steer_suggestion_column].astype(str)
+                       .str.extract(steer_pattern, expand=False)
+                       .astype(float)
+                       .fillna(missing_steer))
+    return dataframe.assign(**{suggested_steer_column: suggested_steer,
+                               difference_column: suggested_steer - dataframe[actual_steer_column]})
 
 
 # Find the difference between the actual steer and the suggested steer
@@ -53,6 +72,30 @@ def find_difference(row):
     return extract_steer(row[steer_suggestion_column]) - row[actual_steer_column]
 
 
+# Load the results of several models into one dataframe with a model column and the parsed steer columns
+def load_results(files):
+    frames = []
+    for name, file_path in files.items():
+        dataframe = load_dataframe(file_path)
+        dataframe[model_column] = name
+        frames.append(dataframe)
+    return add_steer_columns(pd.concat(frames, ignore_index=True))
+
+
+# Results files in a directory, keyed by the model name in front of the file suffix
+def find_result_files(directory=directory_for_data, suffix=steer_suffix):
+    files = sorted(glob.glob(os.path.join(directory, '*' + suffix)))
+    return {os.path.basename(file)[:-len(suffix)]: file for file in files}
+
+
+# Difference and time statistics of every model, computed in one grouped pass
+def summary_table(dataframe):
+    dataframe = add_steer_columns(dataframe)
+    summary = dataframe.groupby(model_column)[[difference_column, time_column]].agg(['count', 'mean', 'std', 'var'])
+    summary.columns = [f'{statistic}_{column}' for column, statistic in summary.columns]
+    return summary.drop(columns=f'count_{time_column}').rename(columns={f'count_{difference_column}': 'count'})
+
+
 # Calculate average time taken to process the data
 def average_time_taken(dataframe):
     return dataframe[time_column].mean()
@@ -70,7 +113,7 @@ def variance_time_taken(dataframe):
 
 # Calculate mean difference for dataframe then extract outliers and return both the mean and outliers
 def mean_difference(dataframe):
-    return dataframe.apply(find_difference, axis=1).mean()
+    return add_steer_columns(dataframe)[difference_column].mean()
 
 
 
@@ -78,14 +121,13 @@ def mean_difference(dataframe):
 # Calculate standard deviation of difference for dataframe then filter outliers and return both the SD and outliers
 def standard_deviation_difference(dataframe):
     # Calculate the standard deviation of the difference
-    data = dataframe.apply(find_difference, axis=1)
-    return data.std()
+    return add_steer_columns(dataframe)[difference_column].std()
 
 
 
 # Calculate variance of difference for dataframe then extract outliers and return both the variance and outliers
 def variance_difference(dataframe):
-    return dataframe.apply(find_difference, axis=1).var()
+    return add_steer_columns(dataframe)[difference_column].var()
 
 
 # Output the information calculated for each dataframe
@@ -177,17 +219,8 @@ def variance_time_taken_graphs(dataframe1, name1, dataframe2, name2, dataframe3,
 
 
 if __name__ == '__main__':
-    # Load the dataframes from the CSV files
-    gemma_dataframe = load_dataframe(directory_for_data + 'gemma:7bsteer_suggestion2.1.csv')
-    mistral_dataframe = load_dataframe(directory_for_data + 'mistralsteer_suggestion2.1.csv')
-    Llama7b_dataframe = load_dataframe(directory_for_data + 'llava:7bsteer_suggestion2.1.csv')
-
-    # Output the information for each dataframe
-    mean_difference_graphs(gemma_dataframe, gemma_7b, mistral_dataframe, mistral, Llama7b_dataframe, llava_7b)
-    standard_deviation_difference_graphs(gemma_dataframe, gemma_7b, mistral_dataframe, mistral, Llama7b_dataframe, llava_7b)
-    variance_difference_graphs(gemma_dataframe, gemma_7b, mistral_dataframe, mistral, Llama7b_dataframe, llava_7b)
-    average_time_taken_graphs(gemma_dataframe, gemma_7b, mistral_dataframe, mistral, Llama7b_dataframe, llava_7b)
-    standard_deviation_time_taken_graphs(gemma_dataframe, gemma_7b, mistral_dataframe, mistral, Llama7b_dataframe, llava_7b)
-    variance_time_taken_graphs(gemma_dataframe, gemma_7b, mistral_dataframe, mistral, Llama7b_dataframe, llava_7b)
-
-
+    # Load the results of every model and output all statistics as one table
+    results = load_results(find_result_files())
+    summary = summary_table(results)
+    print(summary.to_string())
+    summary.to_csv(directory_for_data + 'summary.csv')
@@ -0,0 +1,150 @@
+from bisect import bisect_left, insort
+
+MEAN: str = 'mean'
+MEDIAN: str = 'median'
+EXPONENTIAL: str = 'exponential'
+
+
+class MovingAverageFilter:
+    # Fixed-size ring buffer with a running sum. The window starts filled with zeros and the
+    # average is always taken over the full window, like the original Vehicle.filter_angle.
+    __slots__ = ('size', 'window', 'index', 'sum')
+
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError(f"Filter size must be >= 1, got {size}")
+        self.size = size
+        self.window = [0.0] * size
+        self.index = 0
+        self.sum = 0.0
+
+    def reset(self):
+        for i in range(self.size):
+            self.window[i] = 0.0
+        self.index = 0
+        self.sum = 0.0
+
+    def update(self, value: float) -> float:
+        self.sum += value - self.window[self.index]
+        self.window[self.index] = value
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+            # Re-sum once per lap so rounding errors of the running sum cannot accumulate
+            self.sum = sum(self.window)
+        return self.sum / self.size
+
+    @property
+    def value(self) -> float:
+        return self.sum / self.size
+
+
+class MedianFilter:
+    # Median of the last `size` values, kept in a ring buffer plus a sorted copy of the window.
+    # Until the window is full the median is taken over the values seen so far.
+    __slots__ = ('size', 'window', 'ordered', 'index')
+
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError(f"Filter size must be >= 1, got {size}")
+        self.size = size
+        self.window = [0.0] * size
+        self.ordered = []
+        self.index = 0
+
+    def reset(self):
+        self.ordered.clear()
+        self.index = 0
+
+    def update(self, value: float) -> float:
+        if len(self.ordered) == self.size:
+            del self.ordered[bisect_left(self.ordered, self.window[self.index])]
+        self.window[self.index] = value
+        insort(self.ordered, value)
+        self.index = (self.index + 1) % self.size
+        return self.value
+
+    @property
+    def value(self) -> float:
+        count = len(self.ordered)
+        if count == 0:
+            return 0.0
+        middle = count // 2
+        if count % 2:
+            return self.ordered[middle]
+        return (self.ordered[middle - 1] + self.ordered[middle]) / 2
+
+
+class ExponentialFilter:
+    # Exponential moving average, the first value after a reset initializes the state
+    __slots__ = ('alpha', 'state', 'initialized')
+
+    def __init__(self, alpha: float):
+        if not 0.0 < alpha <= 1.0:
+            raise ValueError(f"alpha must be in (0, 1], got {alpha}")
+        self.alpha = alpha
+        self.state = 0.0
+        self.initialized = False
+
+    def reset(self):
+        self.state = 0.0
+        self.initialized = False
+
+    def update(self, value: float) -> float:
+        if self.initialized:
+            self.state += self.alpha * (value - self.state)
+        else:
+            self.state = value
+            self.initialized = True
+        return self.state
+
+    @property
+    def value(self) -> float:
+        return self.state
+
+
+# Exponential filters use the usual span convention, alpha = 2 / (size + 1)
+def create_filter(kind: str, size: int):
+    if kind == MEAN:
+        return MovingAverageFilter(size)
+    elif kind == MEDIAN:
+        return MedianFilter(size)
+    elif kind == EXPONENTIAL:
+        return ExponentialFilter(2 / (size + 1))
+    raise ValueError(f"Unknown filter kind: {kind}")
+
+
+class PIDController:
+    # State of Vehicle.apply_pid: the integral is cleared whenever the input changes and
+    # only accumulates while it stays within +-integral_limit
+    __slots__ = ('kp', 'ki', 'kd', 'integral_limit', 'integral', 'previous', 'needs_reset')
+
+    def __init__(self, kp: float, ki: float, kd: float, integral_limit: float = 30.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.integral_limit = integral_limit
+        self.integral = 0.0
+        self.previous = 0.0
+        self.needs_reset = False
+
+    # The reset is applied on the next update, which then has no derivative term
+    def reset(self):
+        self.needs_reset = True
+
+    def update(self, value: float) -> float:
+        if self.needs_reset:
+            self.needs_reset = False
+            self.previous = value
+            self.integral = 0.0
+
+        if value != self.previous:
+            self.integral = 0.0
+
+        diff = value - self.previous
+
+        if -self.integral_limit < self.integral < self.integral_limit:
+            self.integral += value
+
+        self.previous = value
+        return self.kp * value + self.ki * self.integral + self.kd * diff
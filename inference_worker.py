@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+class InferenceWorker:
+    # Runs `infer(frame)` on a background thread so the control loop never waits for the model.
+    # Only the newest submitted frame is kept: a frame still waiting when a newer one arrives is dropped.
+    def __init__(self, infer, name: str = "inference-worker"):
+        self.infer = infer
+        self.name = name
+
+        self._condition = threading.Condition()
+        self._pending = None  # (frame, submitted_at) waiting to be processed
+        self._latest = None  # (result, submitted_at) of the most recent completed inference
+        self._thread = None
+        self._running = False
+
+        self.submitted = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self.inference_time = 0.0  # Total seconds spent in infer()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Hands a frame to the worker without blocking; returns False if it replaced a frame that was never processed
+    def submit(self, frame) -> bool:
+        with self._condition:
+            replaced = self._pending is not None
+            if replaced:
+                self.dropped += 1
+            self._pending = (frame, time.monotonic())
+            self.submitted += 1
+            self._condition.notify()
+        return not replaced
+
+    # Returns (result, age in seconds since its frame was submitted), or (None, None) before the first result
+    def latest(self):
+        latest = self._latest
+        if latest is None:
+            return None, None
+        result, submitted_at = latest
+        return result, time.monotonic() - submitted_at
+
+    def metrics(self) -> dict:
+        with self._condition:
+            return {
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "pending": int(self._pending is not None),
+                "average_inference_time": self.inference_time / self.processed if self.processed else 0.0,
+            }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and self._pending is None:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                frame, submitted_at = self._pending
+                self._pending = None
+
+            start = time.monotonic()
+            try:
+                result = self.infer(frame)
+            except Exception as e:
+                print(f"Error in {self.name}: {e}")
+                with self._condition:
+                    self.failed += 1
+                continue
+            elapsed = time.monotonic() - start
+
+            with self._condition:
+                self.processed += 1
+                self.inference_time += elapsed
+            # A single reference assignment, so latest() never needs the lock
+            self._latest = (result, submitted_at)
@@ -1,10 +1,13 @@
-from ollama import chat
+from ollama import chat, Client
 
+import argparse
 import glob
-import pandas as pd
 
-import os
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock, Semaphore
+
+from results_store import ResultsStore
 
 llava_13b = 'llava:13b-v1.6'
 llava_7b = 'llava:7b'
@@ -21,6 +24,9 @@ data_file = 'data/data_without_speed.txt'
 directory_for_data = 'LLM_generated_csv/'
 
 default_model = llava_13b
+default_host = 'http://localhost:11434'
+# Requests in flight per model when running several models concurrently
+default_model_concurrency = 2
 default_prompt = "Change this prompt to suit your needs."
 
 # read text file instructions/instructions.md
@@ -38,19 +44,7 @@ steer_suggestion_column = 'steer_suggestion'
 actual_steer_column = 'actual_steer'
 difference_column = 'difference'
 time_column = 'time_taken'
-
-
-# Load the DataFrame from a CSV file, or create a new one if the file doesn't exist
-def load_or_create_dataframe(description_file):
-    if os.path.isfile(description_file):
-        df = pd.read_csv(description_file)
-    else:
-        df = pd.DataFrame(columns=[lidar_data_column,
-                                   steer_suggestion_column,
-                                   actual_steer_column,
-                                   # difference_column,
-                                   time_column])
-    return df
+columns = [lidar_data_column, steer_suggestion_column, actual_steer_column, time_column]
 
 
 def get_file_lines(file_path):
@@ -72,24 +66,31 @@ def extract_steer( line):
     return ', '.join(remaining_values), steer
 
 class SteerSuggestion:
-    def __init__(self, description_file, model=default_model, prompt=default_prompt):
+    # client: an ollama.Client for a specific host, the default local server is used if None
+    def __init__(self, description_file, model=default_model, prompt=default_prompt, client=None):
         self.description = description_file
         self.model = model
         self.prompt = prompt
-        self.df = load_or_create_dataframe(description_file)
+        self.client = client
+        # Rows of the CSV, including those of earlier runs; new rows are appended to it in chunks
+        self.results = ResultsStore(description_file, columns, lidar_data_column,
+                                    types={actual_steer_column: float, time_column: float})
         self.messages = []
         self.messages.append({'role': 'system', 'content': self.prompt})
+        # Held while a finished query is recorded, so records from several threads add their message and
+        # their row as one step and self.messages stays in the order of the results
+        self.lock = Lock()
 
-    # processing the images
-    def process_data(self, lidar_data_line):
+    @property
+    def df(self):
+        return self.results.to_dataframe()
+
+    # Sends one line of lidar data to the model and returns the row for the DataFrame.
+    # Touches no shared state, so several queries can run at the same time.
+    def query(self, lidar_data_line):
         full_response = ''
         lidar_data, actual_steer = extract_steer(lidar_data_line)
 
-        self.messages.append({
-            'role': 'user',
-            'content': lidar_data
-        })
-
         new_message = [
             {
                 'role': 'user',
@@ -99,14 +100,37 @@ class SteerSuggestion:
 
         start = time.time()
         # Generate a description of the image
-        for response in chat(model=self.model, messages=new_message, stream=True):
+        chat_fn = chat if self.client is None else self.client.chat
+        for response in chat_fn(model=self.model, messages=new_message, stream=True):
             # Print the response to the console and add it to the full response
             # print(response, end='', flush=True) # For debugging purposes
             full_response += response['message']['content']
         end = time.time()
         time_taken = end - start
-        # Add a new row to the DataFrame
-        self.df.loc[len(self.df)] = [lidar_data, full_response, actual_steer, time_taken]
+        return [lidar_data, full_response, actual_steer, time_taken]
+
+    # Adds a row to the results, which are appended to the CSV in chunks so an interrupted run can be resumed
+    def record(self, row):
+        with self.lock:
+            self.messages.append({
+                'role': 'user',
+                'content': row[0]
+            })
+            self.results.append(row)
+
+    # processing the images
+    def process_data(self, lidar_data_line):
+        self.record(self.query(lidar_data_line))
+
+    # Lines whose lidar data is not in the results yet, at most `limit` of them
+    def pending_lines(self, lines, limit):
+        pending = []
+        for line in lines:
+            if len(pending) >= limit:
+                break
+            if extract_steer(line)[0] not in self.results:
+                pending.append(line)
+        return pending
 
     def bulk_process_data(self, file, limit=5):
         lines = get_file_lines(file)
@@ -114,47 +138,73 @@ class SteerSuggestion:
         counter = 0
         print(f"Processing {limit} out of {len(lines)} lines")
         start = time.time()
-        for line in lines:
-            if counter >= limit:
-                break
-            if line not in self.df[lidar_data_column].values:
-                self.process_data(line)
-                print(f"Processed {counter + 1}/{limit}")
-                counter += 1
+        for line in self.pending_lines(lines, limit):
+            self.process_data(line)
+            print(f"Processed {counter + 1}/{limit}")
+            counter += 1
         end = time.time()
         print(f"Processed {counter} images in {end - start:.2f} seconds using {self.model} model.")
 
-        # Save the DataFrame to a CSV file
-        self.df.to_csv(self.description, index=False)
+        # Write the rows of the last chunk to the CSV file
+        self.results.flush()
+
+
+# Runs bulk_process_data for several SteerSuggestion objects at once. Lines of all models are queried
+# on a thread pool, with at most `model_concurrency` requests in flight per model. Every finished row
+# is added to its model's results, which are appended to the CSV in chunks, so rerunning after an
+# interruption only queries the missing lines.
+def run_concurrently(suggestions, file, limit=5, model_concurrency=default_model_concurrency):
+    lines = get_file_lines(file)
+    semaphores = {suggestion.model: Semaphore(model_concurrency) for suggestion in suggestions}
+
+    def process(suggestion, line):
+        with semaphores[suggestion.model]:
+            row = suggestion.query(line)
+        suggestion.record(row)
+        return suggestion
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=len(semaphores) * model_concurrency) as executor:
+        futures = []
+        for suggestion in suggestions:
+            pending = suggestion.pending_lines(lines, limit)
+            print(f"{suggestion.model}: {len(pending)} lines to process")
+            futures += [executor.submit(process, suggestion, line) for line in pending]
+
+        counter = 0
+        for future in as_completed(futures):
+            try:
+                suggestion = future.result()
+            except Exception as e:
+                print(f"Error processing line: {e}")
+                continue
+            counter += 1
+            print(f"Processed {counter}/{len(futures)} ({suggestion.model})")
+    for suggestion in suggestions:
+        suggestion.results.flush()
+    end = time.time()
+    print(f"Processed {counter} lines in {end - start:.2f} seconds using {len(semaphores)} models.")
 
 
 # For testing purposes
 if __name__ == '__main__':
-    steer_suggestion_llava7b = SteerSuggestion(directory_for_data +llava_7b + 'steer_suggestion2.1.csv', model=llava_7b, prompt=default_prompt)
-    steer_suggestion_llava13b = SteerSuggestion(directory_for_data +llava_13b + 'steer_suggestion2.1.csv', model=llava_13b,
-                                                prompt=default_prompt)
-    steer_suggestion_bakllava = SteerSuggestion(directory_for_data +llava_bakllava + 'steer_suggestion2.1.csv', model=llava_bakllava,
-                                                prompt=default_prompt)
-    steer_suggestion_mistral = SteerSuggestion(directory_for_data +llava_mistral + 'steer_suggestion2.1.csv', model=llava_mistral,
-                                               prompt=default_prompt)
-    steer_suggestion_wizard_math = SteerSuggestion(directory_for_data +wizard_math + 'steer_suggestion2.1.csv', model=wizard_math,
-                                                  prompt=default_prompt)
-    steer_suggestion_gemma_7b = SteerSuggestion(directory_for_data +gemma_7b + 'steer_suggestion2.1.csv', model=gemma_7b,
-                                                prompt=default_prompt)
-    steer_suggestion_mixtral = SteerSuggestion(directory_for_data +mixtral + 'steer_suggestion2.1.csv', model=mixtral,
-                                                  prompt=default_prompt)
-    steer_suggestion_wizard_vicuna = SteerSuggestion(directory_for_data +wizard_vicuna + 'steer_suggestion2.1.csv', model=wizard_vicuna,
-                                                    prompt=default_prompt)
-    steer_suggestion_deep_seek_coder = SteerSuggestion(directory_for_data +deep_seek_coder + 'steer_suggestion2.1.csv', model=deep_seek_coder,
-                                                        prompt=default_prompt)
-
-
-    steer_suggestion_llava7b.bulk_process_data(data_file, limit=20)
-    steer_suggestion_llava13b.bulk_process_data(data_file, limit=20)
-    steer_suggestion_bakllava.bulk_process_data(data_file, limit=20)
-    steer_suggestion_mistral.bulk_process_data(data_file, limit=20)
-    steer_suggestion_wizard_math.bulk_process_data(data_file, limit=20)
-    steer_suggestion_gemma_7b.bulk_process_data(data_file, limit=20)
-    steer_suggestion_wizard_vicuna.bulk_process_data(data_file, limit=20)
-    steer_suggestion_deep_seek_coder.bulk_process_data(data_file, limit=20)
-    steer_suggestion_mixtral.bulk_process_data(data_file, limit=20)
+    parser = argparse.ArgumentParser(description='Ask several models for steering suggestions from lidar data.')
+    parser.add_argument('--host', default=default_host, help='Ollama server to query.')
+    parser.add_argument('--limit', type=int, default=20, help='Lines to process per model.')
+    parser.add_argument('--concurrency', type=int, default=default_model_concurrency,
+                        help='Requests in flight per model.')
+    parser.add_argument('--serial', action='store_true', help='Process one model and one line at a time.')
+    args = parser.parse_args()
+
+    client = Client(host=args.host)
+    models = [llava_7b, llava_13b, llava_bakllava, llava_mistral, wizard_math, gemma_7b, wizard_vicuna,
+              deep_seek_coder, mixtral]
+    suggestions = [SteerSuggestion(directory_for_data + model + 'steer_suggestion2.1.csv', model=model,
+                                   prompt=default_prompt, client=client)
+                   for model in models]
+
+    if args.serial:
+        for suggestion in suggestions:
+            suggestion.bulk_process_data(data_file, limit=args.limit)
+    else:
+        run_concurrently(suggestions, data_file, limit=args.limit, model_concurrency=args.concurrency)
@@ -2,13 +2,13 @@ import ollama
 from ollama import generate
 
 import glob
-import pandas as pd
 from PIL import Image
 
-import os
 import time
 from io import BytesIO
 
+from results_store import ResultsStore
+
 directory_for_data = 'LLM_generated_csv/'
 
 llava_7b = 'llava:7b'
@@ -32,15 +32,7 @@ default_prompt = ("The image is taken from an autonomous vehicle, state whether
 description_column = 'description'
 image_column = 'image_file'
 time_column = 'time_taken'
-
-
-# Load the DataFrame from a CSV file, or create a new one if the file doesn't exist
-def load_or_create_dataframe(description_file):
-    if os.path.isfile(description_file):
-        df = pd.read_csv(description_file)
-    else:
-        df = pd.DataFrame(columns=[image_column, description_column, time_column])
-    return df
+columns = [image_column, description_column, time_column]
 
 
 def get_png_files(folder_path):
@@ -52,7 +44,12 @@ class ImageDescription:
         self.description = description_file
         self.model = model
         self.prompt = prompt
-        self.df = load_or_create_dataframe(description_file)
+        # Rows of the CSV, including those of earlier runs; new rows are appended to it in chunks
+        self.results = ResultsStore(description_file, columns, image_column, types={time_column: float})
+
+    @property
+    def df(self):
+        return self.results.to_dataframe()
 
     # processing the images
     def process_image(self, image_file):
@@ -75,8 +72,8 @@ class ImageDescription:
             full_response += response['response']
         end = time.time()
         time_taken = end - start
-        # Add a new row to the DataFrame
-        self.df.loc[len(self.df)] = [image_file, full_response, time_taken]
+        # Add a new row to the results
+        self.results.append([image_file, full_response, time_taken])
 
     def bulk_process_images(self, images_folder, limit=5):
         # image_files = get_png_files(images_folder)
@@ -92,15 +89,15 @@ class ImageDescription:
         for image_file in image_files:
             if counter >= limit:
                 break
-            if image_file not in self.df[image_column].values:
+            if image_file not in self.results:
                 self.process_image(image_file)
                 print(f"Processed {counter}: {image_file}")
                 counter += 1
         end = time.time()
         print(f"Processed {counter} images in {end - start:.2f} seconds using {self.model} model.")
 
-        # Save the DataFrame to a CSV file
-        self.df.to_csv(self.description, index=False)
+        # Write the rows of the last chunk to the CSV file
+        self.results.flush()
 
 
 # For testing purposes
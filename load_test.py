@@ -0,0 +1,100 @@
+"""Load test for the vehicle control API."""
+import argparse
+import http.client
+import json
+import random
+import time
+from threading import Thread
+
+HOST: str = 'localhost'
+PORT: int = 5300
+
+
+# Sends one JSON command per request over a keep-alive connection
+def send_command(connection: http.client.HTTPConnection):
+    body = json.dumps({
+        'speed': random.uniform(0.0, 30.0),
+        'steering': random.uniform(-0.5, 0.5),
+        'brake': 0.0,
+        'indicator': 'off',
+    })
+    connection.request('POST', '/command', body, {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+# The same tick through the old routes: one GET per setter
+def send_legacy(connection: http.client.HTTPConnection):
+    status = 200
+    for path in (f'/setSpeed/{random.uniform(0.0, 30.0)}',
+                 f'/setSteeringAngle/{random.uniform(-0.5, 0.5)}',
+                 '/setBrakeIntensity/0.0'):
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        status = max(status, response.status)
+    return status
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Runs `clients` threads that send control ticks back to back for `duration` seconds
+def run_load_test(host: str = HOST, port: int = PORT, clients: int = 4, duration: float = 10.0,
+                  legacy: bool = False) -> dict:
+    send = send_legacy if legacy else send_command
+    latencies = [[] for _ in range(clients)]
+    errors = [0] * clients
+
+    def client(index: int):
+        connection = http.client.HTTPConnection(host, port, timeout=5)
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                status = send(connection)
+            except (OSError, http.client.HTTPException):
+                errors[index] += 1
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=5)
+                continue
+            if status != 200:
+                errors[index] += 1
+            latencies[index].append(time.perf_counter() - start)
+        connection.close()
+
+    start = time.perf_counter()
+    threads = [Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    all_latencies = [latency for client_latencies in latencies for latency in client_latencies]
+    return {
+        'ticks': len(all_latencies),
+        'errors': sum(errors),
+        'rate': len(all_latencies) / elapsed,
+        'p50_ms': percentile(all_latencies, 0.50) * 1000,
+        'p99_ms': percentile(all_latencies, 0.99) * 1000,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the sustained command rate of the vehicle API.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent connections.')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to run.')
+    parser.add_argument('--legacy', action='store_true', help='Use one GET per setter instead of POST /command.')
+    args = parser.parse_args()
+
+    results = run_load_test(args.host, args.port, args.clients, args.duration, args.legacy)
+    print(f"{results['ticks']} control ticks, {results['errors']} errors, {results['rate']:.0f} ticks/s, "
+          f"p50 {results['p50_ms']:.2f} ms, p99 {results['p99_ms']:.2f} ms")
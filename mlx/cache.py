@@ -0,0 +1,155 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+import mlx.core as mx
+import numpy as np
+
+
+class PromptCache:
+    """
+    LRU cache of the key/value state of constant prompt prefixes, keyed by a
+    hash of their token ids. Entries are evicted least recently used first
+    once ``max_entries`` or ``max_bytes`` would be exceeded.
+    """
+
+    def __init__(self, max_entries: int = 8, max_bytes: int = 1 << 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (layer states, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token_ids) -> str:
+        return hashlib.sha1(np.asarray(token_ids, dtype=np.int64).tobytes()).hexdigest()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: str, states):
+        nbytes = sum(keys.nbytes + values.nbytes for keys, values, _ in states)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        while self.entries and (
+            len(self.entries) >= self.max_entries or self.nbytes + nbytes > self.max_bytes
+        ):
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= evicted
+        self.entries[key] = (states, nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+class VisionFeatureCache:
+    """
+    Cache of projected image features for near-duplicate frames. Each image is
+    keyed by a signature of its pixel values average-pooled to
+    ``signature_size`` x ``signature_size`` per channel; a new image reuses the
+    features of the closest cached signature when their mean absolute
+    difference is below ``threshold``. Least recently used entries are evicted
+    beyond ``max_entries``.
+    """
+
+    def __init__(
+        self, threshold: float = 0.05, max_entries: int = 16, signature_size: int = 12
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.signature_size = signature_size
+        self.signatures = []
+        self.features = []
+        self.hits = 0
+        self.misses = 0
+        self.encode_time = 0.0  # Seconds spent encoding the images that missed
+
+    def signature(self, pixel_values) -> np.ndarray:
+        # (N, C, H, W) -> (N, C * size * size)
+        x = np.array(pixel_values, dtype=np.float32)
+        n, c, h, w = x.shape
+        size = self.signature_size
+        x = x[:, :, : h - h % size, : w - w % size]
+        x = x.reshape(n, c, size, h // size, size, w // size).mean(axis=(3, 5))
+        return x.reshape(n, -1)
+
+    def lookup(self, signature: np.ndarray):
+        if not self.signatures:
+            return None
+        distances = np.abs(np.stack(self.signatures) - signature).mean(axis=1)
+        index = int(np.argmin(distances))
+        if distances[index] >= self.threshold:
+            return None
+        # Move to the most recently used position
+        self.signatures.append(self.signatures.pop(index))
+        self.features.append(self.features.pop(index))
+        return self.features[-1]
+
+    def insert(self, signature: np.ndarray, features: mx.array):
+        self.signatures.append(signature)
+        self.features.append(features)
+        if len(self.signatures) > self.max_entries:
+            self.signatures.pop(0)
+            self.features.pop(0)
+
+    def fetch(self, pixel_values: mx.array, encode):
+        """
+        Returns the projected features of every image in ``pixel_values``,
+        calling ``encode`` only on the images without a cached match.
+        """
+        signatures = self.signature(pixel_values)
+        features = [self.lookup(signature) for signature in signatures]
+        missing = [i for i, f in enumerate(features) if f is None]
+        self.hits += len(features) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            start = time.perf_counter()
+            encoded = encode(pixel_values[mx.array(missing)])
+            mx.eval(encoded)
+            self.encode_time += time.perf_counter() - start
+            for j, i in enumerate(missing):
+                features[i] = encoded[j]
+                self.insert(signatures[i], features[i])
+
+        return mx.stack(features)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(f.nbytes + s.nbytes for f, s in zip(self.features, self.signatures))
+
+    @property
+    def saved_ms(self) -> float:
+        # Hits times the average encoder time of a missed image
+        if not self.misses:
+            return 0.0
+        return self.hits * self.encode_time / self.misses * 1000
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "bytes": self.nbytes,
+            "saved_ms": self.saved_ms,
+        }
+
+    def clear(self):
+        self.signatures.clear()
+        self.features.clear()
@@ -2,14 +2,30 @@
 
 import argparse
 import codecs
+import glob
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import mlx.core as mx
+import numpy as np
 import requests
+from huggingface_hub import snapshot_download
 from PIL import Image
 from transformers import AutoProcessor
 
-from mlx.llava import LlavaModel
+from mlx.cache import PromptCache
+from mlx.language import KVCache, LanguageModel, TextConfig
+from mlx.llava import LlavaModel, load_weight_shards
+from mlx.utils import tree_flatten
 
 
 def parse_arguments():
@@ -43,6 +59,65 @@ def parse_arguments():
     parser.add_argument(
         "--temp", type=float, default=0.3, help="Temperature for sampling."
     )
+    parser.add_argument(
+        "--quantize",
+        type=int,
+        choices=[4, 8],
+        default=None,
+        help="Quantize the language model's linear layers to this many bits.",
+    )
+    parser.add_argument(
+        "--q-group-size", type=int, default=64, help="Group size for quantization."
+    )
+    parser.add_argument(
+        "--quantize-vision",
+        action="store_true",
+        help="Also quantize the vision tower's linear layers.",
+    )
+    parser.add_argument(
+        "--save-path",
+        type=str,
+        default=None,
+        help="Save the (quantized) model and processor to this directory.",
+    )
+    parser.add_argument(
+        "--report-ttft",
+        action="store_true",
+        help="Report the time to first token with and without the prompt prefix cache, then exit.",
+    )
+    parser.add_argument(
+        "--report-startup",
+        action="store_true",
+        help="Report model load time and peak resident memory, then exit.",
+    )
+    parser.add_argument(
+        "--draft-model",
+        type=str,
+        default=None,
+        help="Small Llama model sharing the tokenizer, for greedy speculative decoding.",
+    )
+    parser.add_argument(
+        "--num-draft",
+        type=int,
+        default=4,
+        help="Number of tokens the draft model proposes per verification step.",
+    )
+    parser.add_argument(
+        "--numeric",
+        action="store_true",
+        help="Constrain the output to a single number.",
+    )
+    parser.add_argument(
+        "--early-stop-data",
+        type=str,
+        default=None,
+        help="Lidar data file; report decode steps saved by stopping at the first float.",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Report decode throughput at 128 and 512 generated tokens instead.",
+    )
     return parser.parse_args()
 
 
@@ -70,21 +145,114 @@ def load_image(image_source):
         )
 
 
-def prepare_inputs(processor, image, prompt):
+def load_frame(frame, width=None, height=None, shortest_edge=None):
+    """
+    Helper function to convert a BGRA camera frame, either the raw buffer from
+    camera.getImage() or an (H, W, 4) array, to an RGB array in memory.
+    Optionally resizes it so its shortest edge matches the processor's.
+    """
+    if not isinstance(frame, np.ndarray):
+        if width is None or height is None:
+            raise ValueError("width and height are required to read a raw frame buffer")
+        frame = np.frombuffer(frame, np.uint8).reshape((height, width, 4))
+
+    rgb = np.ascontiguousarray(frame[..., 2::-1])
+
+    if shortest_edge is not None:
+        h, w = rgb.shape[:2]
+        short, long = (w, h) if w <= h else (h, w)
+        if short != shortest_edge:
+            # Same output size as the processor's own resize, so its resize becomes a no-op
+            long = int(shortest_edge * long / short)
+            size = (shortest_edge, long) if w <= h else (long, shortest_edge)
+            rgb = np.asarray(Image.fromarray(rgb).resize(size, Image.BICUBIC))
+    return rgb
+
+
+def prepare_inputs(processor, image, prompt, width=None, height=None):
     if isinstance(image, str):
         image = load_image(image)
+    elif isinstance(image, (bytes, bytearray, memoryview, np.ndarray)):
+        image = load_frame(
+            image, width, height, processor.image_processor.size.get("shortest_edge")
+        )
     inputs = processor(prompt, image, return_tensors="np")
     pixel_values = mx.array(inputs["pixel_values"])
     input_ids = mx.array(inputs["input_ids"])
     return input_ids, pixel_values
 
 
-def load_model(model_path):
+def prepare_batch_inputs(processor, images, prompts, width=None, height=None):
+    """
+    Prepares a batch of images with one prompt each (or the same prompt for
+    all). Prompts are left padded so the last position of every row is a real
+    token; the returned attention mask marks padding with 0.
+    """
+    if isinstance(prompts, str):
+        prompts = [prompts] * len(images)
+    images = [
+        load_image(image)
+        if isinstance(image, str)
+        else load_frame(
+            image, width, height, processor.image_processor.size.get("shortest_edge")
+        )
+        if isinstance(image, (bytes, bytearray, memoryview, np.ndarray))
+        else image
+        for image in images
+    ]
+    processor.tokenizer.padding_side = "left"
+    inputs = processor(prompts, images, padding=True, return_tensors="np")
+    pixel_values = mx.array(inputs["pixel_values"])
+    input_ids = mx.array(inputs["input_ids"])
+    attention_mask = mx.array(inputs["attention_mask"])
+    return input_ids, pixel_values, attention_mask
+
+
+def load_model(model_path, quantization=None):
     processor = AutoProcessor.from_pretrained(model_path)
-    model = LlavaModel.from_pretrained(model_path)
+    model = LlavaModel.from_pretrained(model_path, quantization)
     return processor, model
 
 
+def load_draft_model(model_path):
+    """
+    Loads a small Llama-architecture model (e.g. TinyLlama) that drafts tokens
+    for speculative decoding. It must use the same tokenizer as the LLaVA
+    model; its Hugging Face weight names match ``LanguageModel`` directly.
+    """
+    path = Path(model_path)
+    if not path.exists():
+        path = Path(
+            snapshot_download(
+                repo_id=model_path, allow_patterns=["*.json", "*.safetensors"]
+            )
+        )
+
+    with open(path / "config.json", "r") as f:
+        config = TextConfig.from_dict(json.load(f))
+    model = LanguageModel(config)
+
+    weight_files = glob.glob(str(path / "*.safetensors"))
+    if not weight_files:
+        raise FileNotFoundError(f"No safetensors found in {path}")
+    return load_weight_shards(model, weight_files, LanguageModel.sanitize_weight)
+
+
+def save_model(save_path, processor, model):
+    model.save_pretrained(save_path)
+    processor.save_pretrained(save_path)
+
+
+def parameter_bytes(model):
+    return sum(v.nbytes for _, v in tree_flatten(model.parameters()))
+
+
+def peak_resident_memory():
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
 def sample(logits, temperature=0.0):
     if temperature == 0:
         return mx.argmax(logits, axis=-1)
@@ -92,36 +260,672 @@ def sample(logits, temperature=0.0):
         return mx.random.categorical(logits * (1 / temperature))
 
 
-def generate_text(input_ids, pixel_values, model, processor, max_tokens, temperature):
+def prefill(model, input_ids, pixel_values, prompt_cache=None, prefix_length=None):
+    """
+    Runs the prompt through the model and returns the logits and the cache.
+    With a ``prompt_cache`` the key/value state of the constant text before
+    the first ``<image>`` token (or of the first ``prefix_length`` tokens) is
+    reused across calls, so only the image and the rest of the prompt are
+    prefilled for a new frame.
+    """
+    if prompt_cache is None:
+        return model(input_ids, pixel_values)
+
+    if prefix_length is None:
+        image_positions = np.where(
+            np.array(input_ids[0]) == model.config.image_token_index
+        )[0]
+        prefix_length = int(image_positions[0]) if len(image_positions) else 0
+    if prefix_length <= 0 or prefix_length >= input_ids.shape[1]:
+        return model(input_ids, pixel_values)
 
-    logits, cache = model(input_ids, pixel_values)
-    logits = logits[:, -1, :]
-    y = sample(logits, temperature=temperature)
-    tokens = [y.item()]
+    language_model = model.language_model
+    prefix_ids = input_ids[:, :prefix_length]
+    key = PromptCache.key(prefix_ids)
+    states = prompt_cache.get(key)
+    if states is None:
+        cache = language_model.make_cache()
+        language_model(prefix_ids, cache=cache)
+        states = [c.state for c in cache]
+        mx.eval([(keys, values) for keys, values, _ in states])
+        prompt_cache.put(key, states)
+    cache = [KVCache.from_state(state) for state in states]
 
-    for n in range(max_tokens - 1):
-        logits, cache = model.language_model(y[None], cache=cache)
-        logits = logits[:, -1, :]
-        y = sample(logits, temperature)
+    # The prefix comes before the first image, so its tokens map one to one onto
+    # the first positions of the merged embeddings
+    inputs_embeds = model.get_input_embeddings(input_ids, pixel_values)
+    return language_model(
+        input_ids[:, prefix_length:],
+        cache=cache,
+        inputs_embeds=inputs_embeds[:, prefix_length:],
+    )
+
+
+class FloatStopCondition:
+    """
+    Stop condition that is met once the generated text contains a complete
+    float, i.e. a number followed by a character that cannot continue it.
+    """
+
+    pattern = re.compile(r"[-+]?\d+(?:\.\d+)?(?=[^\d.]|\.[^\d])")
+
+    def __call__(self, text):
+        return self.pattern.search(text) is not None
+
+    @classmethod
+    def parse(cls, text):
+        match = re.search(r"[-+]?\d+(?:\.\d+)?", text)
+        return float(match.group()) if match else None
+
+
+class FloatGrammar:
+    """
+    Logit masks that restrict decoding to an optionally signed decimal number
+    (sign, at most ``max_integer_digits`` digits, at most one decimal point
+    and ``max_fraction_digits`` digits after it) followed by EOS. The tokens
+    allowed in each state of the grammar and the state each of them leads to
+    are precomputed once from the tokenizer vocabulary.
+
+    A state is a ``(kind, digits)`` pair, where ``digits`` counts the digits
+    of the integer or fraction part read so far. At most one whitespace token
+    may come before the number; after it (SPACE) only a sign or a digit is
+    allowed, so decoding cannot spend its steps on spaces.
+    """
+
+    START, SPACE, SIGN, INTEGER, POINT, FRACTION = range(6)
+    characters = set(" +-.0123456789")
+
+    def __init__(self, tokenizer, vocab_size, max_integer_digits=3, max_fraction_digits=4):
+        self.eos_token_id = tokenizer.eos_token_id
+        special_ids = set(tokenizer.all_special_ids)
+        num_tokens = min(len(tokenizer), vocab_size)
+        pieces = tokenizer.convert_ids_to_tokens(list(range(num_tokens)))
+        prefix = re.compile(
+            rf"\s*[-+]?(?:\d{{1,{max_integer_digits}}}(?:\.\d{{0,{max_fraction_digits}}})?)?"
+        )
+
+        # A text in each state, used to test which tokens may follow it
+        examples = {
+            (self.START, 0): "",
+            (self.SPACE, 0): " ",
+            (self.SIGN, 0): "-",
+            (self.POINT, 0): "1.",
+        }
+        for digits in range(1, max_integer_digits + 1):
+            examples[self.INTEGER, digits] = "1" * digits
+        for digits in range(1, max_fraction_digits + 1):
+            examples[self.FRACTION, digits] = "1." + "5" * digits
+
+        # Token id allowlist: tokens made only of number characters
+        self.allowlist = {}
+        for token_id, piece in enumerate(pieces):
+            if token_id in special_ids or piece is None:
+                continue
+            text = piece.replace("\u2581", " ")
+            if text and set(text) <= self.characters:
+                self.allowlist[token_id] = text
+
+        self.transitions = {}
+        self.masks = {}
+        for state, example in examples.items():
+            transitions = {}
+            for token_id, text in self.allowlist.items():
+                if state[0] == self.SPACE and text[0].isspace():
+                    continue
+                if prefix.fullmatch(example + text):
+                    transitions[token_id] = self.classify(example + text)
+            allowed = list(transitions)
+            if self.accepts(state):
+                allowed.append(self.eos_token_id)
+            mask = np.full((vocab_size,), -np.inf, dtype=np.float32)
+            mask[allowed] = 0.0
+            self.transitions[state] = transitions
+            self.masks[state] = mx.array(mask)
+
+    @classmethod
+    def classify(cls, text):
+        if not text.strip():
+            return (cls.SPACE, 0) if text else (cls.START, 0)
+        text = text.strip()
+        number = text.lstrip("+-")
+        if not number:
+            return cls.SIGN, 0
+        integer, point, fraction = number.partition(".")
+        if not point:
+            return cls.INTEGER, len(integer)
+        if not fraction:
+            return cls.POINT, 0
+        return cls.FRACTION, len(fraction)
+
+    @classmethod
+    def accepts(cls, state):
+        return state[0] in (cls.INTEGER, cls.FRACTION)
+
+
+# Grammars per tokenizer, dropped together with it
+_float_grammars = weakref.WeakKeyDictionary()
+
+
+def float_grammar(tokenizer, vocab_size):
+    grammars = _float_grammars.setdefault(tokenizer, {})
+    if vocab_size not in grammars:
+        grammars[vocab_size] = FloatGrammar(tokenizer, vocab_size)
+    return grammars[vocab_size]
+
+
+def generate_number(
+    input_ids,
+    pixel_values,
+    model,
+    processor,
+    max_tokens=16,
+    temperature=0.0,
+    prompt_cache=None,
+):
+    """
+    Decodes a single number under FloatGrammar and returns it as a float, or
+    None if no digit was produced within ``max_tokens``.
+    """
+    logits, cache = prefill(model, input_ids, pixel_values, prompt_cache)
+    grammar = float_grammar(processor.tokenizer, logits.shape[-1])
+
+    state = (FloatGrammar.START, 0)
+    tokens = []
+    for n in range(max_tokens):
+        y = sample(logits[:, -1, :] + grammar.masks[state], temperature)
         token = y.item()
-        if token == processor.tokenizer.eos_token_id:
+        if token == grammar.eos_token_id:
+            break
+        tokens.append(token)
+        state = grammar.transitions[state][token]
+        if n < max_tokens - 1:
+            logits, cache = model.language_model(y[None], cache=cache)
+
+    if state[0] not in (FloatGrammar.INTEGER, FloatGrammar.POINT, FloatGrammar.FRACTION):
+        return None
+    return float(processor.tokenizer.decode(tokens).strip())
+
+
+def sampled_tokens(model, logits, cache, temperature):
+    """
+    Yields one sampled token per forward pass of the language model, starting
+    from the prefill ``logits``. The next pass only runs when the next token
+    is requested.
+    """
+    while True:
+        y = sample(logits[:, -1, :], temperature)
+        yield y.item()
+        logits, cache = model.language_model(y[None], cache=cache)
+
+
+def speculative_tokens(model, draft_model, draft_ids, logits, cache, num_draft=4, stats=None):
+    """
+    Yields the greedy tokens of ``model`` using speculative decoding. The
+    draft model proposes ``num_draft`` tokens, the language model scores all
+    of them in one forward pass, and the longest prefix that matches its own
+    greedy choice is accepted together with the token it predicts after that
+    prefix. Rejected positions are trimmed from both caches.
+
+    ``draft_ids`` is the text prompt without image tokens. If given, ``stats``
+    counts the ``steps``, ``proposed`` and ``accepted`` draft tokens.
+    """
+    language_model = model.language_model
+    token = mx.argmax(logits[:, -1, :], axis=-1).item()
+    yield token
+
+    draft_cache = draft_model.make_cache()
+    pending = draft_ids[0].tolist() + [token]  # Tokens the draft cache has not seen yet
+    while True:
+        draft_logits, draft_cache = draft_model(mx.array([pending]), cache=draft_cache)
+        proposals = []
+        for i in range(num_draft):
+            d = mx.argmax(draft_logits[:, -1, :], axis=-1)
+            proposals.append(d.item())
+            if i < num_draft - 1:
+                draft_logits, draft_cache = draft_model(d[None], cache=draft_cache)
+
+        logits, cache = language_model(mx.array([[token] + proposals]), cache=cache)
+        targets = mx.argmax(logits[0], axis=-1).tolist()
+        accepted = 0
+        while accepted < num_draft and proposals[accepted] == targets[accepted]:
+            accepted += 1
+
+        if stats is not None:
+            stats["steps"] = stats.get("steps", 0) + 1
+            stats["proposed"] = stats.get("proposed", 0) + num_draft
+            stats["accepted"] = stats.get("accepted", 0) + accepted
+
+        # Keep the verified token and the accepted proposals in both caches. The
+        # draft never ran its last proposal, so it is still pending if accepted.
+        for c in cache:
+            c.trim(num_draft - accepted)
+        if accepted < num_draft:
+            for c in draft_cache:
+                c.trim(num_draft - 1 - accepted)
+            pending = [targets[accepted]]
+        else:
+            pending = [proposals[-1], targets[accepted]]
+
+        for t in proposals[:accepted]:
+            yield t
+        token = targets[accepted]
+        yield token
+
+
+def generate_stream(
+    input_ids,
+    pixel_values,
+    model,
+    processor,
+    max_tokens,
+    temperature,
+    prompt_cache=None,
+    stop_condition=None,
+    draft_model=None,
+    num_draft=4,
+    stats=None,
+):
+    """
+    Yields ``(token, text)`` for every generated token, where ``text`` is the
+    decoded output so far. Generation ends at EOS, after ``max_tokens``, or
+    as soon as ``stop_condition(text)`` returns True. With a ``draft_model``
+    greedy decoding is done speculatively (see ``speculative_tokens``).
+    """
+    eos_token_id = processor.tokenizer.eos_token_id
+
+    logits, cache = prefill(model, input_ids, pixel_values, prompt_cache)
+    if draft_model is None:
+        token_source = sampled_tokens(model, logits, cache, temperature)
+    else:
+        if temperature != 0:
+            raise ValueError("Speculative decoding only supports greedy sampling (temperature 0)")
+        draft_ids = input_ids
+        if pixel_values is not None:
+            keep = np.array(input_ids[0]) != model.config.image_token_index
+            draft_ids = input_ids[:, mx.array(np.where(keep)[0])]
+        token_source = speculative_tokens(
+            model, draft_model, draft_ids, logits, cache, num_draft, stats
+        )
+
+    # Only the tokens since the last step are decoded, together with the
+    # previous step's tokens for context (e.g. SentencePiece's leading
+    # spaces), so each step costs the same however long the output is.
+    # A new text that ends in an incomplete UTF-8 sequence is held back
+    # until the next token completes it.
+    decode = processor.tokenizer.decode
+    tokens = []
+    text = ""
+    prefix_offset = read_offset = 0
+    for n, token in zip(range(max_tokens), token_source):
+        if token == eos_token_id:
             break
         tokens.append(token)
+        prefix_text = decode(tokens[prefix_offset:read_offset])
+        new_text = decode(tokens[prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            text += new_text[len(prefix_text):]
+            prefix_offset = read_offset
+            read_offset = len(tokens)
+        yield token, text
+        if stop_condition is not None and stop_condition(text):
+            break
+
+
+def generate_text(
+    input_ids,
+    pixel_values,
+    model,
+    processor,
+    max_tokens,
+    temperature,
+    prompt_cache=None,
+    stop_condition=None,
+    draft_model=None,
+    num_draft=4,
+):
+    text = ""
+    for _, text in generate_stream(
+        input_ids,
+        pixel_values,
+        model,
+        processor,
+        max_tokens,
+        temperature,
+        prompt_cache,
+        stop_condition,
+        draft_model,
+        num_draft,
+    ):
+        pass
+    return text
+
 
-    return processor.tokenizer.decode(tokens)
+def generate_batch(
+    input_ids,
+    pixel_values,
+    attention_mask,
+    model,
+    processor,
+    max_tokens,
+    temperature,
+):
+    """
+    Generates text for every row of a left-padded batch with one batched
+    prefill and one batched forward pass per decoded token. Each row stops
+    collecting tokens at its own EOS; decoding ends when all rows have.
+    """
+    eos_token_id = processor.tokenizer.eos_token_id
+    batch_size = input_ids.shape[0]
+
+    attention_mask = model.expand_attention_mask(input_ids, attention_mask)
+    inputs_embeds = model.get_input_embeddings(input_ids, pixel_values)
+    logits, cache = model.language_model(
+        input_ids, inputs_embeds=inputs_embeds, attention_mask=attention_mask
+    )
+    y = sample(logits[:, -1, :], temperature)
+
+    tokens = [[] for _ in range(batch_size)]
+    finished = [False] * batch_size
+    for n in range(max_tokens):
+        for b, token in enumerate(y.tolist()):
+            if finished[b]:
+                continue
+            if token == eos_token_id:
+                finished[b] = True
+            else:
+                tokens[b].append(token)
+        if all(finished) or n == max_tokens - 1:
+            break
+
+        attention_mask = mx.concatenate(
+            [attention_mask, mx.ones((batch_size, 1), attention_mask.dtype)], axis=1
+        )
+        logits, cache = model.language_model(
+            y[:, None], cache=cache, attention_mask=attention_mask
+        )
+        y = sample(logits[:, -1, :], temperature)
+
+    return [processor.tokenizer.decode(t) for t in tokens]
+
+
+def benchmark_batch_throughput(
+    model, processor, images, prompt, batch_sizes=(1, 4, 8), max_tokens=32
+):
+    """
+    Reports images per second of generate_batch at each batch size. The
+    image list is cycled to fill the larger batches.
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        batch = [images[i % len(images)] for i in range(batch_size)]
+        input_ids, pixel_values, attention_mask = prepare_batch_inputs(
+            processor, batch, prompt
+        )
+        start = time.perf_counter()
+        generate_batch(
+            input_ids, pixel_values, attention_mask, model, processor, max_tokens, 0.0
+        )
+        elapsed = time.perf_counter() - start
+        results[batch_size] = batch_size / elapsed
+        print(f"batch {batch_size}: {results[batch_size]:.2f} images/s")
+    return results
+
+
+def _quantization_run(model_path, images, prompt, quantization, max_tokens):
+    processor, model = load_model(model_path, quantization)
+    mx.eval(model.parameters())
+
+    texts = []
+    tokens = 0
+    elapsed = 0.0
+    for image in images:
+        input_ids, pixel_values = prepare_inputs(processor, image, prompt)
+        start = time.perf_counter()
+        text = generate_text(
+            input_ids, pixel_values, model, processor, max_tokens, 0.0
+        )
+        elapsed += time.perf_counter() - start
+        tokens += len(processor.tokenizer.encode(text, add_special_tokens=False))
+        texts.append(text)
+
+    return texts, {
+        "weight_bytes": parameter_bytes(model),
+        "peak_rss_bytes": peak_resident_memory(),
+        "tokens_per_second": tokens / elapsed,
+    }
+
+
+def benchmark_quantization(
+    model_path, images, prompt, quantization, max_tokens=64
+):
+    """
+    Compares a quantized model with the full precision one on a fixed image
+    set: weight memory, peak resident memory, decode tokens per second and how
+    often the greedy outputs agree.
+    """
+    results = {}
+    outputs = {}
+    # ru_maxrss only ever grows, so each variant runs in a fresh process to
+    # report its own peak. Quantizing on load builds the full precision
+    # weights first; pass a directory saved with --quantize to leave that out.
+    context = multiprocessing.get_context("spawn")
+    for name, q in (("quantized", quantization), ("full", None)):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            outputs[name], results[name] = pool.submit(
+                _quantization_run, model_path, images, prompt, q, max_tokens
+            ).result()
+
+    agreement = sum(a == b for a, b in zip(outputs["full"], outputs["quantized"]))
+    results["exact_agreement"] = agreement / len(images)
+    for name in ("full", "quantized"):
+        r = results[name]
+        print(
+            f"{name}: weights {r['weight_bytes'] / 2**30:.2f} GiB, "
+            f"peak RSS {r['peak_rss_bytes'] / 2**30:.2f} GiB, "
+            f"{r['tokens_per_second']:.2f} tokens/s"
+        )
+    print(f"Identical outputs: {agreement}/{len(images)}")
+    return results
+
+
+def benchmark_early_stop(model, processor, prompts, max_tokens=128):
+    """
+    Counts the decode steps needed per text-only prompt with and without
+    stopping at the first complete float.
+    """
+    steps = {"full": 0, "early_stop": 0}
+    for prompt in prompts:
+        input_ids = mx.array(processor.tokenizer(prompt, return_tensors="np")["input_ids"])
+        for name, stop_condition in (("full", None), ("early_stop", FloatStopCondition())):
+            for _ in generate_stream(
+                input_ids, None, model, processor, max_tokens, 0.0,
+                stop_condition=stop_condition,
+            ):
+                steps[name] += 1
+
+    print(
+        f"Decode steps over {len(prompts)} prompts: {steps['full']} without early stop, "
+        f"{steps['early_stop']} with early stop "
+        f"({steps['full'] - steps['early_stop']} saved)"
+    )
+    return steps
+
+
+def lidar_prompts(instructions_file, data_file, limit=None):
+    """
+    Builds the steering prompts used by llm_lidar.py: the instructions followed
+    by one line of sensor data without its recorded steer value.
+    """
+    with open(instructions_file, "r") as f:
+        instructions = f.read()
+    prompts = []
+    with open(data_file, "r") as f:
+        for line in f.readlines()[:limit]:
+            values = [v for v in line.strip().split(", ") if not v.startswith("steer: ")]
+            prompts.append(f"USER: {instructions}{', '.join(values)}\nASSISTANT:")
+    return prompts
+
+
+def benchmark_prepare_inputs(processor, frame, prompt, repeats=20):
+    """
+    Compares the per-call latency of preparing a BGRA frame through a JPEG
+    file round trip with the in-memory path.
+    """
+    image_location = os.path.join(tempfile.gettempdir(), "image.jpg")
+
+    def file_round_trip():
+        Image.fromarray(frame[..., 2::-1]).save(image_location, quality=100)
+        inputs = prepare_inputs(processor, image_location, prompt)
+        os.remove(image_location)
+        return inputs
+
+    def in_memory():
+        return prepare_inputs(processor, frame, prompt)
+
+    results = {}
+    for name, fn in (("file", file_round_trip), ("memory", in_memory)):
+        mx.eval(*fn())  # Warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            mx.eval(*fn())
+        results[name] = (time.perf_counter() - start) / repeats * 1000
+        print(f"{name}: {results[name]:.2f} ms/call")
+    return results
+
+
+def benchmark_generation(model, processor, image, prompt, token_counts=(128, 512)):
+    """
+    Measures decode throughput in tokens per second. EOS is ignored so every
+    run decodes exactly the requested number of tokens.
+    """
+    input_ids, pixel_values = prepare_inputs(processor, image, prompt)
+
+    results = {}
+    for num_tokens in token_counts:
+        logits, cache = model(input_ids, pixel_values)
+        y = sample(logits[:, -1, :])
+        mx.eval(y)
+
+        start = time.perf_counter()
+        for _ in range(num_tokens - 1):
+            logits, cache = model.language_model(y[None], cache=cache)
+            y = sample(logits[:, -1, :])
+            mx.eval(y)
+        elapsed = time.perf_counter() - start
+
+        results[num_tokens] = (num_tokens - 1) / elapsed
+        print(f"{num_tokens} tokens: {results[num_tokens]:.2f} tokens/s")
+    return results
+
+
+def benchmark_speculative(
+    model, draft_model, processor, image, prompt, max_tokens=128, num_draft=4
+):
+    """
+    Compares greedy decoding with and without the draft model. Reports the
+    draft acceptance rate and the wall-clock speedup, and checks that both
+    produce the same tokens.
+    """
+    input_ids, pixel_values = prepare_inputs(processor, image, prompt)
+
+    runs = {}
+    stats = {}
+    for name, draft in (("greedy", None), ("speculative", draft_model)):
+        start = time.perf_counter()
+        tokens = [
+            token
+            for token, _ in generate_stream(
+                input_ids, pixel_values, model, processor, max_tokens, 0.0,
+                draft_model=draft, num_draft=num_draft, stats=stats,
+            )
+        ]
+        runs[name] = (tokens, time.perf_counter() - start)
+        print(f"{name}: {len(tokens)} tokens in {runs[name][1]:.2f} s")
+
+    if runs["greedy"][0] != runs["speculative"][0]:
+        print("Warning: speculative output differs from greedy decoding")
+    acceptance = stats["accepted"] / stats["proposed"] if stats.get("proposed") else 0.0
+    speedup = runs["greedy"][1] / runs["speculative"][1]
+    print(f"Acceptance rate {acceptance:.1%}, speedup {speedup:.2f}x")
+    return acceptance, speedup
+
+
+def benchmark_prompt_cache(model, processor, image, prompt, repeats=5):
+    """
+    Reports the time to first token with and without a prompt prefix cache.
+    The cached run is warmed up once so every measured call is a cache hit.
+    """
+    input_ids, pixel_values = prepare_inputs(processor, image, prompt)
+    prompt_cache = PromptCache()
+
+    results = {}
+    for name, cache in (("uncached", None), ("cached", prompt_cache)):
+        mx.eval(prefill(model, input_ids, pixel_values, cache)[0])  # Warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            logits, _ = prefill(model, input_ids, pixel_values, cache)
+            mx.eval(sample(logits[:, -1, :]))
+        results[name] = (time.perf_counter() - start) / repeats * 1000
+        print(f"{name}: {results[name]:.1f} ms to first token")
+    return results
 
 
 def main():
     args = parse_arguments()
-    processor, model = load_model(args.model)
+    quantization = None
+    if args.quantize is not None:
+        quantization = {
+            "group_size": args.q_group_size,
+            "bits": args.quantize,
+            "vision": args.quantize_vision,
+        }
+    start = time.perf_counter()
+    processor, model = load_model(args.model, quantization)
+    if args.report_startup:
+        print(f"Loaded in {time.perf_counter() - start:.2f} s")
+        print(f"Peak RSS {peak_resident_memory() / 2**30:.2f} GiB")
+        return
+
+    if args.save_path is not None:
+        save_model(args.save_path, processor, model)
 
     prompt = codecs.decode(args.prompt, "unicode_escape")
+    if args.report_ttft:
+        benchmark_prompt_cache(model, processor, args.image, prompt)
+        return
+
+    draft_model = load_draft_model(args.draft_model) if args.draft_model else None
+
+    if args.benchmark:
+        if draft_model is not None:
+            benchmark_speculative(
+                model, draft_model, processor, args.image, prompt,
+                args.max_tokens, args.num_draft,
+            )
+            return
+        benchmark_generation(model, processor, args.image, prompt)
+        return
+
+    if args.early_stop_data is not None:
+        prompts = lidar_prompts("instructions/instructions_2.md", args.early_stop_data)
+        benchmark_early_stop(model, processor, prompts, args.max_tokens)
+        return
 
     input_ids, pixel_values = prepare_inputs(processor, args.image, prompt)
 
     print(prompt)
+    if args.numeric:
+        print(
+            generate_number(
+                input_ids, pixel_values, model, processor, args.max_tokens, args.temp
+            )
+        )
+        return
+
     generated_text = generate_text(
-        input_ids, pixel_values, model, processor, args.max_tokens, args.temp
+        input_ids, pixel_values, model, processor, args.max_tokens,
+        0.0 if draft_model is not None else args.temp,
+        draft_model=draft_model, num_draft=args.num_draft,
     )
     print(generated_text)
 
@@ -2,7 +2,7 @@
 
 import inspect
 from dataclasses import dataclass
-from typing import Dict, Optional, Tuple, Union
+from typing import Dict, Optional, Union
 
 import mlx.core as mx
 import mlx.nn as nn
@@ -45,6 +45,93 @@ class TextConfig:
                 raise ValueError("rope_scaling 'type' currently only supports 'linear'")
 
 
+class KVCache:
+    """
+    Key/value cache of one attention layer. Storage is allocated in chunks of
+    ``step`` positions and new keys and values are written in place, so the
+    history is not copied on every decoded token.
+    """
+
+    def __init__(self, head_dim: int, n_kv_heads: int, step: int = 256):
+        self.head_dim = head_dim
+        self.n_kv_heads = n_kv_heads
+        self.step = step
+        self.keys = None
+        self.values = None
+        self.offset = 0
+
+    def update_and_fetch(self, keys: mx.array, values: mx.array):
+        prev = self.offset
+        B, _, L, _ = keys.shape
+        if self.keys is None or prev + L > self.keys.shape[2]:
+            n_steps = (self.step + L - 1) // self.step
+            shape = (B, self.n_kv_heads, n_steps * self.step, self.head_dim)
+            new_k = mx.zeros(shape, keys.dtype)
+            new_v = mx.zeros(shape, values.dtype)
+            if self.keys is not None:
+                if prev % self.step != 0:
+                    self.keys = self.keys[..., :prev, :]
+                    self.values = self.values[..., :prev, :]
+                self.keys = mx.concatenate([self.keys, new_k], axis=2)
+                self.values = mx.concatenate([self.values, new_v], axis=2)
+            else:
+                self.keys, self.values = new_k, new_v
+
+        self.offset += L
+        self.keys[..., prev : self.offset, :] = keys
+        self.values[..., prev : self.offset, :] = values
+        return self.keys[..., : self.offset, :], self.values[..., : self.offset, :]
+
+    def trim(self, n: int) -> int:
+        """
+        Drops the last ``n`` cached positions, e.g. rejected speculative
+        tokens; they are overwritten by the next update.
+        """
+        n = min(self.offset, n)
+        self.offset -= n
+        return n
+
+    @property
+    def state(self):
+        return self.keys, self.values, self.offset
+
+    @classmethod
+    def from_state(cls, state, step: int = 256):
+        # Copies the cached positions into a fresh buffer, the state itself is never written to
+        keys, values, offset = state
+        cache = cls(keys.shape[-1], keys.shape[1], step)
+        cache.update_and_fetch(keys[..., :offset, :], values[..., :offset, :])
+        return cache
+
+
+def create_causal_mask(N: int, offset: int = 0):
+    """
+    Additive causal mask for N new positions attending to ``offset`` cached
+    positions followed by themselves.
+    """
+    rinds = mx.arange(offset + N)
+    linds = mx.arange(offset, offset + N) if offset else rinds
+    mask = linds[:, None] < rinds[None]
+    return mask * -1e9
+
+
+def create_attention_mask(N: int, offset: int, attention_mask: mx.array):
+    """
+    Additive causal mask of shape (B, 1, N, offset + N) that also hides padding.
+    ``attention_mask`` is (B, offset + N) with 1 for real tokens and 0 for
+    padding. Padding positions still attend to themselves so that their rows
+    of the softmax stay finite.
+    """
+    rinds = mx.arange(offset + N)
+    linds = mx.arange(offset, offset + N)
+    allowed = linds[:, None] >= rinds[None]
+    allowed = allowed & (
+        attention_mask[:, None, None, :].astype(mx.bool_)
+        | (linds[:, None] == rinds[None])
+    )
+    return mx.where(allowed, 0.0, -1e9)
+
+
 class Attention(nn.Module):
     def __init__(self, config: TextConfig):
         super().__init__()
@@ -80,7 +167,7 @@ class Attention(nn.Module):
         self,
         x: mx.array,
         mask: Optional[mx.array] = None,
-        cache: Optional[Tuple[mx.array, mx.array]] = None,
+        cache: Optional[KVCache] = None,
     ) -> mx.array:
         B, L, D = x.shape
 
@@ -92,11 +179,9 @@ class Attention(nn.Module):
         values = values.reshape(B, L, self.n_kv_heads, -1).transpose(0, 2, 1, 3)
 
         if cache is not None:
-            key_cache, value_cache = cache
-            queries = self.rope(queries, offset=key_cache.shape[2])
-            keys = self.rope(keys, offset=key_cache.shape[2])
-            keys = mx.concatenate([key_cache, keys], axis=2)
-            values = mx.concatenate([value_cache, values], axis=2)
+            queries = self.rope(queries, offset=cache.offset)
+            keys = self.rope(keys, offset=cache.offset)
+            keys, values = cache.update_and_fetch(keys, values)
         else:
             queries = self.rope(queries)
             keys = self.rope(keys)
@@ -105,7 +190,7 @@ class Attention(nn.Module):
             queries, keys, values, scale=self.scale, mask=mask
         )
         output = output.transpose(0, 2, 1, 3).reshape(B, L, -1)
-        return self.o_proj(output), (keys, values)
+        return self.o_proj(output), cache
 
 
 class MLP(nn.Module):
@@ -136,7 +221,7 @@ class TransformerBlock(nn.Module):
         self,
         x: mx.array,
         mask: Optional[mx.array] = None,
-        cache: Optional[Tuple[mx.array, mx.array]] = None,
+        cache: Optional[KVCache] = None,
     ) -> mx.array:
         r, cache = self.self_attn(self.input_layernorm(x), mask, cache)
         h = x + r
@@ -163,6 +248,7 @@ class Llama(nn.Module):
         inputs: mx.array,
         cache=None,
         inputs_embeds=None,
+        attention_mask=None,
     ):
         # for passing merged input embeddings
         if inputs_embeds is None:
@@ -170,19 +256,28 @@ class Llama(nn.Module):
         else:
             h = inputs_embeds
 
+        if cache is None:
+            cache = self.make_cache()
+
         mask = None
-        if h.shape[1] > 1:
-            mask = nn.MultiHeadAttention.create_additive_causal_mask(h.shape[1])
+        if attention_mask is not None:
+            mask = create_attention_mask(h.shape[1], cache[0].offset, attention_mask)
+            mask = mask.astype(h.dtype)
+        elif h.shape[1] > 1:
+            mask = create_causal_mask(h.shape[1], cache[0].offset)
             mask = mask.astype(h.dtype)
-
-        if cache is None:
-            cache = [None] * len(self.layers)
 
         for e, layer in enumerate(self.layers):
             h, cache[e] = layer(h, mask, cache[e])
 
         return self.norm(h), cache
 
+    def make_cache(self):
+        head_dim = self.config.hidden_size // self.config.num_attention_heads
+        return [
+            KVCache(head_dim, self.config.num_key_value_heads) for _ in self.layers
+        ]
+
 
 class LanguageModel(nn.Module):
     def __init__(self, config: TextConfig):
@@ -200,13 +295,23 @@ class LanguageModel(nn.Module):
         inputs: mx.array,
         cache=None,
         inputs_embeds=None,
+        attention_mask=None,
     ):
-        out, cache = self.model(inputs, cache, inputs_embeds)
+        out, cache = self.model(inputs, cache, inputs_embeds, attention_mask)
         return self.lm_head(out), cache
 
+    def make_cache(self):
+        return self.model.make_cache()
+
     @staticmethod
-    def sanitize(weights):
+    def sanitize_weight(k, v):
         # Remove unused precomputed rotary freqs
+        if "self_attn.rotary_emb.inv_freq" in k:
+            return None
+        return k, v
+
+    @staticmethod
+    def sanitize(weights):
         return {
             k: v for k, v in weights.items() if "self_attn.rotary_emb.inv_freq" not in k
         }
\ No newline at end of file
@@ -3,7 +3,7 @@
 import glob
 import inspect
 import json
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 from pathlib import Path
 from typing import Optional
 
@@ -11,6 +11,7 @@ import mlx.core as mx
 import mlx.nn as nn
 import numpy as np
 from huggingface_hub import snapshot_download
+from mlx.utils import tree_flatten
 from mlx.language import LanguageModel, TextConfig
 from mlx.vision import VisionConfig, VisionModel
 
@@ -24,6 +25,8 @@ class LlaVAConfig:
     vision_feature_select_strategy: str = "default"
     vision_feature_layer: int = -2
     vocab_size: int = 32000
+    # {"group_size": int, "bits": int, "vision": bool} for quantized weights
+    quantization: Optional[dict] = None
 
     @classmethod
     def from_dict(cls, params):
@@ -54,6 +57,63 @@ class LlavaMultiModalProjector(nn.Module):
         return x
 
 
+def quantize_model(model, group_size: int = 64, bits: int = 4, vision: bool = False):
+    """
+    Quantizes the nn.Linear layers of the language model, and optionally of
+    the vision tower, in place. Layers whose input dimension is not a multiple
+    of ``group_size`` are left in full precision.
+    """
+
+    def class_predicate(path, module):
+        return isinstance(module, nn.Linear) and module.weight.shape[-1] % group_size == 0
+
+    nn.quantize(model.language_model, group_size, bits, class_predicate=class_predicate)
+    if vision:
+        nn.quantize(model.vision_tower, group_size, bits, class_predicate=class_predicate)
+    model.config.quantization = {"group_size": group_size, "bits": bits, "vision": vision}
+    return model
+
+
+def load_weight_shards(model, weight_files, sanitize_weight):
+    """
+    Loads safetensors shards into ``model`` one at a time, sanitizing them
+    tensor by tensor with ``sanitize_weight(k, v)``, which returns the
+    (possibly renamed or transposed) item or None to drop it. Shards written
+    by ``LlavaModel.save_pretrained`` are already sanitized. Each shard is
+    evaluated into the model before the next one is opened, so the weights
+    are never held twice.
+    """
+    expected = {k: v.shape for k, v in tree_flatten(model.parameters())}
+    loaded = set()
+    for wf in weight_files:
+        shard = []
+        weights, metadata = mx.load(wf, return_metadata=True)
+        native = metadata.get("format") == "mlx"
+        for k, v in weights.items():
+            if not native:
+                item = sanitize_weight(k, v)
+                if item is None:
+                    continue
+                k, v = item
+            if k not in expected:
+                raise ValueError(f"Received parameter not in model: {k}.")
+            if v.shape != expected[k]:
+                raise ValueError(
+                    f"Expected shape {expected[k]} but received "
+                    f"shape {v.shape} for parameter {k}"
+                )
+            shard.append((k, v))
+        model.load_weights(shard, strict=False)
+        mx.eval([v for _, v in shard])
+        loaded.update(k for k, _ in shard)
+        del shard, weights
+
+    missing = sorted(set(expected) - loaded)
+    if missing:
+        raise ValueError(f"Missing parameters: {', '.join(missing)}.")
+    return model
+
+
 class LlavaModel(nn.Module):
     def __init__(self, config: LlaVAConfig):
         self.config = config
@@ -62,6 +122,8 @@ class LlavaModel(nn.Module):
         self.multi_modal_projector = LlavaMultiModalProjector(config)
         self.vision_feature_layer = config.vision_feature_layer
         self.vision_feature_select_strategy = config.vision_feature_select_strategy
+        # Optional mlx.cache.VisionFeatureCache, skips the vision tower for near-duplicate frames
+        self.feature_cache = None
 
     def get_input_embeddings(
         self,
@@ -69,11 +131,23 @@ class LlavaModel(nn.Module):
         pixel_values: Optional[mx.array] = None,
     ):
         if pixel_values is None:
-            return self.language_model(input_ids)
+            return self.language_model.model.embed_tokens(input_ids)
 
         # Get the input embeddings from the language model
         inputs_embeds = self.language_model.model.embed_tokens(input_ids)
 
+        if self.feature_cache is None:
+            image_features = self.encode_images(pixel_values)
+        else:
+            image_features = self.feature_cache.fetch(pixel_values, self.encode_images)
+
+        # Insert special image tokens in the input_ids
+        final_inputs_embeds = self._merge_input_ids_with_image_features(
+            image_features, inputs_embeds, input_ids
+        )
+        return final_inputs_embeds
+
+    def encode_images(self, pixel_values: mx.array):
         # Get the ouptut hidden states from the vision model
         *_, hidden_states = self.vision_tower(
             pixel_values.transpose(0, 2, 3, 1), output_hidden_states=True
@@ -93,13 +167,7 @@ class LlavaModel(nn.Module):
             )
 
         # Pass image features through the multi-modal projector
-        image_features = self.multi_modal_projector(selected_image_feature)
-
-        # Insert special image tokens in the input_ids
-        final_inputs_embeds = self._merge_input_ids_with_image_features(
-            image_features, inputs_embeds, input_ids
-        )
-        return final_inputs_embeds
+        return self.multi_modal_projector(selected_image_feature)
 
     def _merge_input_ids_with_image_features(
         self, image_features, inputs_embeds, input_ids
@@ -107,39 +175,77 @@ class LlavaModel(nn.Module):
         image_token_index = self.config.image_token_index
         num_images, num_image_patches, embed_dim = image_features.shape
 
-        # Positions of <image> tokens in input_ids, assuming batch size is 1
-        image_positions = np.where(input_ids[0] == image_token_index)[0].tolist()
+        # Positions of <image> tokens in each row of input_ids, images are
+        # consumed in row order
+        ids = np.array(input_ids)
+        image_positions = [np.where(row == image_token_index)[0].tolist() for row in ids]
 
-        if len(image_positions) != num_images:
+        num_image_tokens = sum(len(positions) for positions in image_positions)
+        if num_image_tokens != num_images:
             raise ValueError(
-                f"The number of image tokens ({len(image_positions)}) does not "
+                f"The number of image tokens ({num_image_tokens}) does not "
                 f" match the number of image inputs ({num_images})."
             )
-
-        text_segments = []
-        start_idx = 0
-
-        for position in image_positions:
-            text_segments.append(inputs_embeds[:, start_idx:position])
-            start_idx = position + 1
-
-        image_embeddings = mx.split(image_features, image_features.shape[0])
-        final_embeddings = [v for p in zip(text_segments, image_embeddings) for v in p]
-        final_embeddings += [inputs_embeds[:, start_idx:]]
+        if len({len(positions) for positions in image_positions}) > 1:
+            raise ValueError("Every row must contain the same number of image tokens.")
+
+        rows = []
+        image_index = 0
+        for b, positions in enumerate(image_positions):
+            segments = []
+            start_idx = 0
+            for position in positions:
+                segments.append(inputs_embeds[b, start_idx:position])
+                segments.append(image_features[image_index])
+                image_index += 1
+                start_idx = position + 1
+            segments.append(inputs_embeds[b, start_idx:])
+            rows.append(mx.concatenate(segments, axis=0))
 
         # Create a final embedding of shape
-        # (1, num_image_patches*num_images + sequence_len, embed_dim)
-        return mx.concatenate(final_embeddings, axis=1)
+        # (batch, num_image_patches*num_images_per_row + sequence_len, embed_dim)
+        return mx.stack(rows)
+
+    def expand_attention_mask(self, input_ids, attention_mask, num_image_patches=None):
+        """
+        Expands a (B, L) padding mask over input_ids to the merged sequence, in
+        which every <image> token is replaced by its image patches.
+        """
+        if num_image_patches is None:
+            vision_config = self.config.vision_config
+            num_image_patches = (vision_config.image_size // vision_config.patch_size) ** 2
+            if self.vision_feature_select_strategy == "full":
+                num_image_patches += 1
+        ids = np.array(input_ids)
+        mask = np.array(attention_mask)
+        repeats = np.where(ids == self.config.image_token_index, num_image_patches, 1)
+        return mx.array(
+            np.stack([np.repeat(m, r) for m, r in zip(mask, repeats)]).astype(np.int32)
+        )
 
-    def __call__(self, input_ids: mx.array, pixel_values: mx.array, cache=None):
+    def __call__(
+        self, input_ids: mx.array, pixel_values: mx.array, cache=None, attention_mask=None
+    ):
         input_embddings = self.get_input_embeddings(input_ids, pixel_values)
+        if attention_mask is not None and pixel_values is not None:
+            attention_mask = self.expand_attention_mask(input_ids, attention_mask)
         logits, cache = self.language_model(
-            input_ids, cache=cache, inputs_embeds=input_embddings
+            input_ids,
+            cache=cache,
+            inputs_embeds=input_embddings,
+            attention_mask=attention_mask,
         )
         return logits, cache
 
     @staticmethod
-    def from_pretrained(path_or_hf_repo: str):
+    def from_pretrained(path_or_hf_repo: str, quantization: Optional[dict] = None):
+        """
+        Loads a model from a local directory or Hugging Face repo. With
+        ``quantization`` ({"group_size", "bits", "vision"}) the weights are
+        quantized after loading; a directory written by ``save_pretrained``
+        is reloaded without sanitizing or quantizing again, and a requested
+        quantization must then match the saved one.
+        """
         path = Path(path_or_hf_repo)
         if not path.exists():
             path = Path(
@@ -168,12 +274,41 @@ class LlavaModel(nn.Module):
         if not weight_files:
             raise FileNotFoundError(f"No safetensors found in {path}")
 
-        weights = {}
-        for wf in weight_files:
-            weights.update(mx.load(wf))
+        saved_quantization = model_config.quantization
+        if quantization is not None and saved_quantization is not None:
+            requested = {"group_size": 64, "bits": 4, "vision": False, **quantization}
+            if requested != saved_quantization:
+                raise ValueError(
+                    f"{path} is saved with quantization {saved_quantization}, "
+                    f"which does not match the requested {quantization}"
+                )
+        if saved_quantization is not None:
+            # Weights written by save_pretrained are already quantized
+            quantize_model(model, **saved_quantization)
+
+        load_weight_shards(model, weight_files, LlavaModel.sanitize_weight)
 
-        weights = VisionModel.sanitize(weights)
-        weights = LanguageModel.sanitize(weights)
+        if quantization is not None and saved_quantization is None:
+            quantize_model(model, **quantization)
+        return model
 
-        model.load_weights(list(weights.items()))
-        return model
\ No newline at end of file
+    @staticmethod
+    def sanitize_weight(k, v):
+        item = VisionModel.sanitize_weight(k, v)
+        if item is None:
+            return None
+        return LanguageModel.sanitize_weight(*item)
+
+    def save_pretrained(self, path: str):
+        """
+        Writes the (possibly quantized) weights and a config that
+        ``from_pretrained`` can reload directly.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        weights = dict(tree_flatten(self.parameters()))
+        mx.save_safetensors(str(path / "model.safetensors"), weights, metadata={"format": "mlx"})
+
+        with open(path / "config.json", "w") as f:
+            json.dump(asdict(self.config), f, indent=4)
@@ -204,20 +204,26 @@ class VisionModel(nn.Module):
     ) -> mx.array:
         return self.vision_model(x, output_hidden_states)
 
+    @staticmethod
+    def sanitize_weight(k, v):
+        if "position_ids" in k:
+            # Remove unused position_ids
+            return None
+        elif "patch_embedding.weight" in k:
+            # PyTorch conv2d weight tensors have shape:
+            #   [out_channels, in_channels, kH, KW]
+            # MLX conv2d expects the weight be of shape:
+            #   [out_channels, kH, KW, in_channels]
+            return k, v.transpose(0, 2, 3, 1)
+        else:
+            return k, v
+
     @staticmethod
     def sanitize(weights):
         sanitized_weights = {}
         for k, v in weights.items():
-            if "position_ids" in k:
-                # Remove unused position_ids
-                continue
-            elif "patch_embedding.weight" in k:
-                # PyTorch conv2d weight tensors have shape:
-                #   [out_channels, in_channels, kH, KW]
-                # MLX conv2d expects the weight be of shape:
-                #   [out_channels, kH, KW, in_channels]
-                sanitized_weights[k] = v.transpose(0, 2, 3, 1)
-            else:
-                sanitized_weights[k] = v
+            item = VisionModel.sanitize_weight(k, v)
+            if item is not None:
+                sanitized_weights[item[0]] = item[1]
 
         return sanitized_weights
\ No newline at end of file
@@ -0,0 +1,369 @@
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+
+UNKNOWN: float = 99999.99  # Unknown value for Camera and Lidar data
+
+#  Yellow line detection
+YELLOW_LINE_COLOR: tuple[int, int, int] = (95, 187, 203)  # (B, G, R) of the yellow line
+YELLOW_LINE_THRESHOLD: int = 30  # Max L1 distance to the reference color
+
+#  Lidar obstacle detection
+OBSTACLE_DISTANCE: float = 20.0  # (in m) Beams shorter than this hit an obstacle
+LIDAR_HALF_AREA: int = 20  # Beams checked to the left and right of the vehicle by process_sick_lidar
+LIDAR_SECTORS: int = 9  # Number of sectors the scan is split into
+FREE_SPACE_BINS: tuple = (0.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)  # (in m) Edges of the free-space histogram
+
+
+def color_diff(a, b):
+    diff = 0
+    for i in range(3):
+        d = a[i] - b[i]
+        if d > 0:
+            diff += d
+        else:
+            diff -= d
+
+    # print(diff)
+    return diff
+
+
+# View the BGRA buffer returned by camera.getImage() as a (H, W, 4) uint8 array without copying it
+def as_bgra_array(image, width: int, height: int) -> np.ndarray:
+    if isinstance(image, np.ndarray):
+        return image.reshape((height, width, 4))
+    return np.frombuffer(image, np.uint8).reshape((height, width, 4))
+
+
+# Per-channel lookup tables of |value - ref| clamped to the threshold, so the three
+# channel distances can be summed in uint8 without overflowing
+@lru_cache(maxsize=8)
+def _color_diff_tables(ref: tuple, threshold: int):
+    dtype = np.uint8 if threshold * 3 <= 255 else np.uint16
+    values = np.arange(256)
+    return tuple(np.minimum(np.abs(values - c), threshold).astype(dtype) for c in ref)
+
+
+# Boolean mask of the pixels within `threshold` (L1 distance over B, G, R) of the reference color
+def yellow_line_mask(pixels: np.ndarray, ref=YELLOW_LINE_COLOR, threshold: int = YELLOW_LINE_THRESHOLD):
+    blue, green, red = _color_diff_tables(tuple(ref), threshold)
+    diff = np.take(blue, pixels[..., 0])
+    diff += np.take(green, pixels[..., 1])
+    diff += np.take(red, pixels[..., 2])
+    return diff < threshold
+
+
+# Returns the angle of the centroid of the masked pixels, UNKNOWN when the mask is empty
+def centroid_angle(mask: np.ndarray, width: int, fov: float, columns: np.ndarray = None):
+    column_counts = np.count_nonzero(mask, axis=0)
+    pixel_count = int(column_counts.sum())
+    if pixel_count == 0:
+        return UNKNOWN
+
+    if columns is None:
+        columns = np.arange(mask.shape[1])
+    # Integer sums keep the result identical to the per-pixel implementation
+    sum_of_x = int(np.dot(column_counts.astype(np.int64), columns.astype(np.int64)))
+
+    return ((sum_of_x / pixel_count / width) - 0.5) * fov
+
+
+def process_camera_image(image, width: int, height: int, fov: float):
+    mask = yellow_line_mask(as_bgra_array(image, width, height))
+    return centroid_angle(mask, width, fov)
+
+
+class LaneDetector:
+    # Searches a band of rows for the yellow line, optionally subsampling rows/columns and narrowing
+    # the columns to a window around the previous frame's centroid (adaptive mode)
+    def __init__(self, width: int, height: int, fov: float, roi: tuple[float, float] = (0.0, 1.0),
+                 row_stride: int = 1, column_stride: int = 1, adaptive_window: float = None):
+        if not 0.0 <= roi[0] < roi[1] <= 1.0:
+            raise ValueError(f"roi must be (top, bottom) fractions with 0 <= top < bottom <= 1, got {roi}")
+        if row_stride < 1 or column_stride < 1:
+            raise ValueError("row_stride and column_stride must be >= 1")
+
+        self.width = width
+        self.height = height
+        self.fov = fov
+        self.row_start = int(roi[0] * height)
+        self.row_stop = max(int(roi[1] * height), self.row_start + 1)
+        self.row_stride = row_stride
+        self.column_stride = column_stride
+        # Half width of the adaptive search window in pixels, None disables adaptive mode
+        self.adaptive_half_width = None if adaptive_window is None else max(int(adaptive_window * width), 1)
+        self.previous_column = None
+
+    def reset(self):
+        self.previous_column = None
+
+    def detect(self, image):
+        pixels = as_bgra_array(image, self.width, self.height)
+        rows = pixels[self.row_start:self.row_stop:self.row_stride]
+
+        if self.adaptive_half_width is not None and self.previous_column is not None:
+            angle = self._detect_in_columns(rows, self.previous_column - self.adaptive_half_width,
+                                            self.previous_column + self.adaptive_half_width + 1)
+            if angle != UNKNOWN:
+                return angle
+            # Lost the line inside the window, search the whole band again
+
+        return self._detect_in_columns(rows, 0, self.width)
+
+    # Returns (angle, angle - full frame angle); the difference is UNKNOWN when only one of them found the line
+    def evaluate(self, image):
+        angle = self.detect(image)
+        full_frame_angle = process_camera_image(image, self.width, self.height, self.fov)
+        if angle == UNKNOWN and full_frame_angle == UNKNOWN:
+            return angle, 0.0
+        if angle == UNKNOWN or full_frame_angle == UNKNOWN:
+            return angle, UNKNOWN
+        return angle, angle - full_frame_angle
+
+    def _detect_in_columns(self, rows: np.ndarray, start: int, stop: int):
+        # Keep the sampled columns on the same stride grid whatever the window position
+        start = max(start, 0)
+        start += -start % self.column_stride
+        stop = min(stop, self.width)
+
+        mask = yellow_line_mask(rows[:, start:stop:self.column_stride])
+        angle = centroid_angle(mask, self.width, self.fov, np.arange(start, stop, self.column_stride))
+
+        if angle == UNKNOWN:
+            self.previous_column = None
+        else:
+            self.previous_column = int((angle / self.fov + 0.5) * self.width)
+        return angle
+
+
+# Runs every detector over the frames and reports its latency and deviation from the full-frame result
+def compare_lane_detectors(frames: list, detectors: dict, width: int, height: int, fov: float):
+    import time
+
+    results = {}
+    for name, detector in detectors.items():
+        detector.reset()
+        elapsed = 0.0
+        errors = []
+        misses = 0
+        for frame in frames:
+            start = time.perf_counter()
+            angle = detector.detect(frame)
+            elapsed += time.perf_counter() - start
+
+            full_frame_angle = process_camera_image(frame, width, height, fov)
+            if (angle == UNKNOWN) != (full_frame_angle == UNKNOWN):
+                misses += 1
+            elif angle != UNKNOWN:
+                errors.append(abs(angle - full_frame_angle))
+
+        results[name] = {
+            "ms_per_frame": elapsed / len(frames) * 1000,
+            "mean_abs_error": float(np.mean(errors)) if errors else 0.0,
+            "max_abs_error": float(np.max(errors)) if errors else 0.0,
+            "misses": misses,
+        }
+        print(f"{name:>10}: {results[name]['ms_per_frame']:.3f} ms/frame, "
+              f"mean |error| {results[name]['mean_abs_error']:.5f} rad, "
+              f"max |error| {results[name]['max_abs_error']:.5f} rad, misses {misses}")
+    return results
+
+
+@dataclass
+class LidarScanAnalysis:
+    sector_angles: np.ndarray  # Center angle of each sector (in rad)
+    sector_min_distance: np.ndarray  # Closest return in each sector (in m, inf when nothing was hit)
+    cluster_angles: np.ndarray  # Centroid angle of each obstacle cluster (in rad)
+    cluster_min_distance: np.ndarray  # Closest return of each obstacle cluster (in m)
+    free_space_histogram: np.ndarray  # Number of beams per FREE_SPACE_BINS distance bin
+    obstacle: tuple[float, float]  # (angle, distance) as returned by process_sick_lidar
+
+
+def beam_angles(width: int, fov: float, indices=None):
+    if indices is None:
+        indices = np.arange(width)
+    return (np.asarray(indices) / width - 0.5) * fov
+
+
+# Returns approximate (angle, distance) of the obstacle in front of the vehicle
+def process_sick_lidar(ranges, width: int, fov: float, half_area: int = LIDAR_HALF_AREA,
+                       threshold: float = OBSTACLE_DISTANCE):
+    start = round(width / 2 - half_area)
+    # Slice before converting: only the central window is needed, and for the plain list returned by
+    # Lidar.getRangeImage a loop over those few beams is cheaper than building an array
+    window = ranges[start:round(width / 2 + half_area)]
+
+    if isinstance(window, np.ndarray):
+        hits = np.flatnonzero(window < threshold)
+        count = hits.size
+        if count == 0:
+            return UNKNOWN, 0.0
+        sum_of_x = int(hits.sum()) + start * count
+        # cumsum adds sequentially, matching the original running total bit for bit
+        total_distance = float(np.cumsum(window[hits], dtype=np.float64)[-1])
+    else:
+        sum_of_x = 0
+        count = 0
+        total_distance = 0.0
+        for x, distance in enumerate(window, start):
+            if distance < threshold:
+                sum_of_x += x
+                count += 1
+                total_distance += distance
+        if count == 0:
+            return UNKNOWN, 0.0
+
+    return (sum_of_x / count / width - 0.5) * fov, total_distance / count
+
+
+# Analyses the whole scan in one pass: per-sector minimum distance, obstacle clusters
+# (runs of consecutive beams closer than `threshold`) and a histogram of free space
+def analyze_lidar_scan(ranges, fov: float, num_sectors: int = LIDAR_SECTORS,
+                       threshold: float = OBSTACLE_DISTANCE, bins=FREE_SPACE_BINS) -> LidarScanAnalysis:
+    scan = np.asarray(ranges, dtype=np.float64)
+    width = scan.size
+    bins = np.asarray(bins, dtype=np.float64)
+
+    sector_starts = np.arange(num_sectors) * width // num_sectors
+    sector_centers = (sector_starts + np.append(sector_starts[1:], width)) / 2
+    sector_min_distance = np.fmin.reduceat(scan, sector_starts)  # fmin skips nan returns
+
+    hits = scan < threshold
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], hits, [False])).astype(np.int8)))
+    cluster_starts, cluster_stops = edges[::2], edges[1::2]
+    if cluster_starts.size:
+        # Each reduceat segment runs until the next cluster starts, the beams in between are all
+        # >= threshold so the minimum always comes from the cluster itself
+        cluster_min_distance = np.fmin.reduceat(scan, cluster_starts)  # fmin skips nan returns
+    else:
+        cluster_min_distance = np.empty(0)
+    cluster_angles = beam_angles(width, fov, (cluster_starts + cluster_stops - 1) / 2)
+
+    # Beams without a return (inf/nan) or beyond the last edge count towards the last bin
+    bin_index = np.searchsorted(bins, scan, side='right').clip(1, bins.size - 1) - 1
+    free_space_histogram = np.bincount(bin_index, minlength=bins.size - 1)
+
+    return LidarScanAnalysis(
+        sector_angles=beam_angles(width, fov, sector_centers),
+        sector_min_distance=sector_min_distance,
+        cluster_angles=cluster_angles,
+        cluster_min_distance=cluster_min_distance,
+        free_space_histogram=free_space_histogram,
+        obstacle=process_sick_lidar(scan, width, fov, threshold=threshold),
+    )
+
+
+# Original per-beam implementation, kept as the reference for equivalence checks
+def process_sick_lidar_reference(lidar_data: list[float], width: int, fov: float):
+    sum_of_x = 0
+    collision_count = 0
+    obstacle_distance = 0.0
+
+    for x in range(round(width / 2 - LIDAR_HALF_AREA), round(width / 2 + LIDAR_HALF_AREA)):
+        if lidar_data[x] < OBSTACLE_DISTANCE:
+            sum_of_x += x
+            collision_count += 1
+            obstacle_distance += lidar_data[x]
+
+    if collision_count == 0:
+        return UNKNOWN, obstacle_distance
+
+    obstacle_distance /= collision_count
+
+    return (sum_of_x / collision_count / width - 0.5) * fov, obstacle_distance
+
+
+# Original per-pixel implementation, kept as the reference for equivalence checks and benchmarks
+def process_camera_image_reference(image: bytes, width: int, height: int, fov: float):
+    num_pixels = width * height
+    ref = list(YELLOW_LINE_COLOR)
+    sum_of_x = 0
+    pixel_count = 0
+
+    for x in range(num_pixels):
+        pixel = image[x * 4: x * 4 + 3]  # Extract BGR values from image
+        if color_diff(pixel, ref) < YELLOW_LINE_THRESHOLD:
+            sum_of_x += x % width
+            pixel_count += 1
+
+    if pixel_count == 0:
+        return UNKNOWN
+
+    return ((sum_of_x / pixel_count / width) - 0.5) * fov
+
+
+def synthetic_camera_frame(width: int, height: int, line_column: int, seed: int = 0) -> bytes:
+    # Random background with a yellow line drawn in the lower half of the frame
+    rng = np.random.default_rng(seed)
+    frame = rng.integers(0, 256, size=(height, width, 4), dtype=np.uint8)
+    frame[height // 2:, max(line_column - 2, 0):line_column + 2, :3] = YELLOW_LINE_COLOR
+    return frame.tobytes()
+
+
+def benchmark_camera(width: int = 256, height: int = 128, fov: float = 1.0, repeats: int = 20):
+    import time
+
+    image = synthetic_camera_frame(width, height, width // 3)
+
+    start = time.perf_counter()
+    reference = process_camera_image_reference(image, width, height, fov)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        vectorized = process_camera_image(image, width, height, fov)
+    vectorized_time = (time.perf_counter() - start) / repeats
+
+    assert vectorized == reference, f"Mismatch: {vectorized} != {reference}"
+    print(f"Reference: {reference_time * 1000:.2f} ms/frame")
+    print(f"Vectorized: {vectorized_time * 1000:.3f} ms/frame")
+    print(f"Speedup: {reference_time / vectorized_time:.1f}x")
+
+
+def benchmark_lane_detectors(width: int = 256, height: int = 128, fov: float = 1.0, num_frames: int = 50):
+    # Line drifting slowly across the frame, as it does while the car follows a curve
+    frames = [synthetic_camera_frame(width, height, width // 4 + i, seed=i) for i in range(num_frames)]
+    detectors = {
+        "full": LaneDetector(width, height, fov),
+        "roi": LaneDetector(width, height, fov, roi=(0.5, 1.0)),
+        "strided": LaneDetector(width, height, fov, roi=(0.5, 1.0), row_stride=2, column_stride=2),
+        "adaptive": LaneDetector(width, height, fov, roi=(0.5, 1.0), adaptive_window=0.1),
+    }
+    return compare_lane_detectors(frames, detectors, width, height, fov)
+
+
+def benchmark_lidar(width: int = 180, fov: float = math.pi, repeats: int = 1000):
+    import time
+
+    rng = np.random.default_rng(0)
+    scan = rng.uniform(1.0, 80.0, width)
+    scan[width // 2 - 8:width // 2 + 3] = rng.uniform(5.0, 8.0, 11)  # Obstacle ahead
+    scan[rng.integers(0, width, 10)] = np.inf
+    scan = scan.tolist()  # getRangeImage() returns a list
+
+    reference = process_sick_lidar_reference(scan, width, fov)
+    assert process_sick_lidar(scan, width, fov) == reference
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        process_sick_lidar_reference(scan, width, fov)
+    reference_time = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        analysis = analyze_lidar_scan(scan, fov)
+    analysis_time = (time.perf_counter() - start) / repeats
+
+    print(f"Reference: {reference_time * 1e6:.1f} us/scan")
+    print(f"Full scan analysis: {analysis_time * 1e6:.1f} us/scan")
+    print(f"Sector minimum distances: {np.round(analysis.sector_min_distance, 2)}")
+    print(f"{analysis.cluster_angles.size} obstacle clusters, free space histogram {analysis.free_space_histogram}")
+
+
+# For testing purposes
+if __name__ == '__main__':
+    benchmark_camera()
+    benchmark_lane_detectors()
+    benchmark_lidar()
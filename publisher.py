@@ -1,11 +1,14 @@
 import json
+import time
+from collections import deque
 
 from confluent_kafka import Producer
 from numpy import inf
+import numpy as np
 import PIL.Image as Image
 import io
 
-from controller import LidarPoint
+import sensor_codec
 
 
 #  Definition of Topics
@@ -13,10 +16,22 @@ CAMERA_IMAGE_DATA_TOPIC: str = 'CameraImageRawData'
 LIDAR_RANGE_IMAGE_DATA_TOPIC: str = 'LidarRangeImageRawData'
 LIDAR_POINT_CLOUD_DATA_TOPIC: str = 'LidarPointCloudRawData'
 
+#  Backpressure policies for asynchronous publishing, applied when the producer queue is full
+DROP_OLDEST: str = 'drop_oldest'  # Keep the newest messages in a bounded local backlog
+BLOCK: str = 'block'  # Wait up to block_timeout for room, then drop the message
+SAMPLE: str = 'sample'  # Keep one of every sample_every messages in the backlog
 
-#  Function to remove inf and nan from data
+
+#  Layout of a WbLidarPoint, as returned by lidar.getPointCloud(data_type='buffer')
+LIDAR_POINT_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('layer', '<i4'), ('time', '<f4')])
+POINT_CLOUD_COLUMNS: tuple = ('x', 'y', 'z', 'time', 'layer')  # Column order of the published (N, 5) array
+
+
+#  Function to remove inf and nan from data, arrays are sanitized in place
 def remove_inf_and_nan(data):
-    if data == inf:
+    if isinstance(data, np.ndarray):
+        return np.nan_to_num(data, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+    elif data == inf:
         return 0.0
     elif data == -inf:
         return 0.0
@@ -26,55 +41,244 @@ def remove_inf_and_nan(data):
         return data
 
 
+class PointCloudBuffer:
+    # Preallocated (N, 5) float32 array of x, y, z, time, layer, reused across ticks and only
+    # grown when a scan has more points than any previous one
+    def __init__(self, capacity: int = 0):
+        self.points = np.empty((capacity, len(POINT_CLOUD_COLUMNS)), np.float32)
+
+    # Returns a view on the buffer holding the captured points
+    def capture(self, point_cloud, sanitize: bool = False) -> np.ndarray:
+        if isinstance(point_cloud, (bytes, bytearray, memoryview)):
+            raw = np.frombuffer(point_cloud, LIDAR_POINT_DTYPE)
+        else:
+            # List of LidarPoint objects, the slow path when the raw buffer is not available
+            raw = np.fromiter(((p.x, p.y, p.z, p.layer, p.time) for p in point_cloud), LIDAR_POINT_DTYPE,
+                              count=len(point_cloud))
+
+        if raw.size > self.points.shape[0]:
+            self.points = np.empty((raw.size, len(POINT_CLOUD_COLUMNS)), np.float32)
+        points = self.points[:raw.size]
+        for i, column in enumerate(POINT_CLOUD_COLUMNS):
+            points[:, i] = raw[column]
+
+        if sanitize:
+            remove_inf_and_nan(points)
+        return points
+
+
 def show_image(image: bytes):
     image = Image.open(io.BytesIO(image))
     image.show()
 
 
 class Publisher:
-    def __init__(self, server: str):
-        self.publisher = Producer({'bootstrap.servers': server})
+    # With asynchronous=True messages are batched by the producer (linger_ms, batch_size, compression),
+    # delivery is reported through callbacks and flush() only happens, bounded, in close()
+    def __init__(self, server: str, asynchronous: bool = False, linger_ms: int = 5, batch_size: int = 1000000,
+                 compression: str = 'lz4', queue_size: int = 10000, backpressure: str = DROP_OLDEST,
+                 block_timeout: float = 0.01, sample_every: int = 10, on_delivery=None, producer=None):
+        if backpressure not in (DROP_OLDEST, BLOCK, SAMPLE):
+            raise ValueError(f"Unknown backpressure policy: {backpressure}")
+
+        config = {'bootstrap.servers': server}
+        if asynchronous:
+            config.update({
+                'linger.ms': linger_ms,
+                'batch.size': batch_size,
+                'compression.type': compression,
+                'queue.buffering.max.messages': queue_size,
+            })
+        self.publisher = producer if producer is not None else Producer(config)
         self.i = 0
 
+        self.asynchronous = asynchronous
+        self.backpressure = backpressure
+        self.block_timeout = block_timeout
+        self.sample_every = sample_every
+        self.on_delivery = on_delivery
+        self.backlog = deque(maxlen=queue_size)  # Messages waiting for room in the producer queue
+        self.point_cloud_buffer = PointCloudBuffer()
+
+        self.produced = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.publish_calls = 0
+        self.sampled = 0  # Messages seen while sampling under backpressure
+        self.publish_time = 0.0  # Total seconds spent inside publish()
+
     def publish(self, topic: str, key: str, data: str):
 
         data = {"channel": topic, "data": {topic: data}, "topic": topic}
         data = json.dumps(data)
 
+        self._send(topic, key, data)
+        return f"Published to {topic} with key {key} and value {data}"
+
+    # Publishes an array in the sensor_codec binary envelope instead of JSON
+    def publish_array(self, topic: str, key: str, array: np.ndarray, timestamp: float):
+        self._send(topic, key, sensor_codec.encode(array, timestamp))
+
+    def _send(self, topic: str, key: str, value):
+        start = time.perf_counter()
         try:
-            self.publisher.produce(topic, key=key, value=data)
-            self.publisher.flush()
+            if self.asynchronous:
+                self._produce_async(topic, key, value)
+            else:
+                self.publisher.produce(topic, key=key, value=value)
+                self.publisher.flush()
+                self.produced += 1
         except Exception as e:
             print(f"Error publishing to {topic}: {e}")
-        return f"Published to {topic} with key {key} and value {data}"
+        self.publish_time += time.perf_counter() - start
+        self.publish_calls += 1
 
-    def publish_lidar_data(self, time_step: int, point_cloud_data: list[LidarPoint], range_image: list[float]):
-
-        # range_image = [remove_inf_and_nan(x) for x in range_image]
-        range_image = str(range_image)
-
-        point_cloud = []
-        for point in point_cloud_data:  # Extract Lidar Points from Object
-            # point_cloud.append({
-            #     "x": remove_inf_and_nan(point.x),
-            #     "y": remove_inf_and_nan(point.y),
-            #     "z": remove_inf_and_nan(point.z),
-            #     "time": remove_inf_and_nan(point.time),
-            #     "layer": remove_inf_and_nan(point.layer)
-            # })
-            point_cloud.append({
-                "x": point.x,
-                "y": point.y,
-                "z": point.z,
-                "time": point.time,
-                "layer": point.layer
+    def _produce_async(self, topic: str, key: str, value):
+        # Older messages go first so the topic order is preserved
+        while self.backlog:
+            if not self._try_produce(*self.backlog[0]):
+                break
+            self.backlog.popleft()
 
-            })
-        point_cloud = str(point_cloud)
+        if self.backlog or not self._try_produce(topic, key, value):
+            self._apply_backpressure(topic, key, value)
+
+        self.publisher.poll(0)  # Serve delivery callbacks
+
+    def _try_produce(self, topic: str, key: str, value) -> bool:
+        try:
+            self.publisher.produce(topic, key=key, value=value, on_delivery=self._delivery_report)
+        except BufferError:
+            return False
+        self.produced += 1
+        return True
+
+    def _apply_backpressure(self, topic: str, key: str, value):
+        message = (topic, key, value)
+        if self.backpressure == BLOCK:
+            deadline = time.monotonic() + self.block_timeout
+            while time.monotonic() < deadline:
+                self.publisher.poll(max(deadline - time.monotonic(), 0))
+                if self._try_produce(*message):
+                    return
+            self.dropped += 1
+            return
+
+        if self.backpressure == SAMPLE:
+            self.sampled += 1
+            if self.sampled % self.sample_every != 0:
+                self.dropped += 1
+                return
+
+        if len(self.backlog) == self.backlog.maxlen:
+            self.dropped += 1  # The deque discards its oldest message
+        self.backlog.append(message)
+
+    def _delivery_report(self, err, msg):
+        if err is not None:
+            self.failed += 1
+        else:
+            self.delivered += 1
+        if self.on_delivery is not None:
+            self.on_delivery(err, msg)
+
+    def stats(self) -> dict:
+        return {
+            "produced": self.produced,
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "backlog": len(self.backlog),
+            "average_publish_time": self.publish_time / self.publish_calls if self.publish_calls else 0.0,
+        }
+
+    # Bounded flush of the backlog and the producer queue; returns the number of messages left undelivered
+    def close(self, timeout: float = 5.0) -> int:
+        deadline = time.monotonic() + timeout
+        while self.backlog and time.monotonic() < deadline:
+            if self._try_produce(*self.backlog[0]):
+                self.backlog.popleft()
+            else:
+                self.publisher.poll(0.01)
+        remaining = self.publisher.flush(max(deadline - time.monotonic(), 0))
+        return remaining + len(self.backlog)
+
+    # point_cloud_data is the raw buffer from lidar.getPointCloud(data_type='buffer'), a list of LidarPoint
+    # or an (N, 5) float32 array; sanitize replaces inf and nan values with 0.0
+    def publish_lidar_data(self, time_step: int, point_cloud_data, range_image: list[float],
+                           sanitize: bool = False):
+        range_image = np.array(range_image, dtype=np.float32)
+
+        if isinstance(point_cloud_data, np.ndarray):
+            point_cloud = remove_inf_and_nan(point_cloud_data) if sanitize else point_cloud_data
+        else:
+            point_cloud = self.point_cloud_buffer.capture(point_cloud_data, sanitize)
+        if sanitize:
+            remove_inf_and_nan(range_image)
+
+        self.publish_array(LIDAR_RANGE_IMAGE_DATA_TOPIC, str(time_step), range_image, time_step)
+        self.publish_array(LIDAR_POINT_CLOUD_DATA_TOPIC, str(time_step), point_cloud, time_step)
+
+    # image is either an (H, W, 4) BGRA array or the raw camera buffer together with its width and height
+    def publish_camera_data(self, time_step: int, image, width: int = None, height: int = None):
+        if not isinstance(image, np.ndarray):
+            image = np.frombuffer(image, np.uint8).reshape((height, width, 4))
+        self.publish_array(CAMERA_IMAGE_DATA_TOPIC, str(time_step), image, time_step)
+
+
+class InProcessProducer:
+    # Stand-in for confluent_kafka.Producer: buffers messages locally, "delivers" them once they
+    # have lingered for linger_ms and makes every flush() cost one simulated broker round trip
+    def __init__(self, queue_size: int = 10000, linger_ms: float = 5.0, round_trip_ms: float = 2.0):
+        self.queue_size = queue_size
+        self.linger = linger_ms / 1000
+        self.round_trip = round_trip_ms / 1000
+        self.queue = deque()  # (enqueued_at, topic, key, value, on_delivery)
+        self.delivered = []
+
+    def produce(self, topic, key=None, value=None, on_delivery=None):
+        if len(self.queue) >= self.queue_size:
+            raise BufferError("Local: Queue full")
+        self.queue.append((time.monotonic(), topic, key, value, on_delivery))
+
+    def poll(self, timeout=0):
+        if timeout:
+            time.sleep(timeout)
+        return self._deliver(time.monotonic() - self.linger)
+
+    def flush(self, timeout=None):
+        time.sleep(self.round_trip)
+        self._deliver(float('inf'))
+        return len(self.queue)
+
+    def _deliver(self, enqueued_before: float) -> int:
+        count = 0
+        while self.queue and self.queue[0][0] <= enqueued_before:
+            _, topic, key, value, on_delivery = self.queue.popleft()
+            self.delivered.append((topic, key, value))
+            if on_delivery is not None:
+                on_delivery(None, (topic, key, value))
+            count += 1
+        return count
+
+    def __len__(self):
+        return len(self.queue)
+
+
+def benchmark_publish(messages: int = 500, round_trip_ms: float = 2.0):
+    data = str({"yellow_line_angle": 0.01, "obstacle_distance": 12.5, "obstacle_angle": -0.1})
+    for asynchronous in (False, True):
+        publisher = Publisher('', asynchronous=asynchronous,
+                              producer=InProcessProducer(round_trip_ms=round_trip_ms))
+        for i in range(messages):
+            publisher.publish('CarSensorData', str(i), data)
+        left = publisher.close()
+        stats = publisher.stats()
+        print(f"{'async' if asynchronous else 'sync':>5}: {stats['average_publish_time'] * 1e6:.1f} us/publish, "
+              f"delivered {len(publisher.publisher.delivered)}, dropped {stats['dropped']}, left {left}")
 
-        self.publish(LIDAR_RANGE_IMAGE_DATA_TOPIC, str(time_step), range_image)
-        self.publish(LIDAR_POINT_CLOUD_DATA_TOPIC, str(time_step), point_cloud)
 
-    def publish_camera_data(self, time_step: int, image: bytes):
-        image = str(image)
-        self.publish(CAMERA_IMAGE_DATA_TOPIC, str(time_step), image)
+# For testing purposes
+if __name__ == '__main__':
+    benchmark_publish()
@@ -0,0 +1,137 @@
+import csv
+import os
+from threading import Lock
+
+
+class ResultsStore:
+    # Rows of one results CSV, kept as a list per column plus a set of the keys already processed,
+    # so appending a row and checking a key are both O(1). New rows are buffered and appended to the
+    # CSV every `flush_every` rows; an interrupted run loses at most the last unflushed chunk.
+    # `types` maps columns to a function that converts their text in the CSV back to the type of the values
+    # appended, e.g. float; an empty field is loaded as None.
+    def __init__(self, path: str, columns: list, key_column: str, flush_every: int = 20, types: dict | None = None):
+        if key_column not in columns:
+            raise ValueError(f"Key column {key_column} is not one of {columns}")
+        self.path = path
+        self.columns = list(columns)
+        self.key_index = self.columns.index(key_column)
+        self.flush_every = flush_every
+        self.types = [(self.columns.index(column), convert) for column, convert in (types or {}).items()]
+
+        self.data = {column: [] for column in self.columns}
+        self.keys = set()
+        self.pending = []  # Rows not written to the CSV yet
+        self.lock = Lock()
+        self.skipped = 0  # Records of the CSV that could not be loaded
+        self.damaged_tail: int | None = None  # Offset of an unfinished record at the end of the CSV
+        self.missing_newline = False  # The CSV does not end with a line ending
+
+        if os.path.isfile(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'rb') as file:
+            data = file.read()
+
+        # Fields may span lines, so lines are fed to the csv reader one at a time; `end` is where the last
+        # line it consumed ends, and where the next record starts
+        end = 0
+
+        def lines():
+            nonlocal end
+            while end < len(data):
+                start = end
+                end = data.find(b'\n', start) + 1 or len(data)
+                yield data[start:end].decode()
+
+        # The file is only read here. Records that do not parse are skipped and the reader carries on
+        # with the next line; the file is repaired before the first append (see _repair)
+        reader = csv.reader(lines(), strict=True)
+        header = None
+        while True:
+            start = end
+            try:
+                row = next(reader)
+            except StopIteration:
+                break
+            except csv.Error:
+                # A quote still open at the end of the file was cut short by an interrupted write
+                if end == len(data) and data.count(b'"', start) % 2:
+                    self.damaged_tail = start
+                self.skipped += 1
+                continue
+
+            if header is None:
+                if row != self.columns:
+                    raise ValueError(f"{self.path} has columns {row}, expected {self.columns}")
+                header = row
+            elif row:  # Not a blank line
+                try:
+                    self._add(self._convert(row))
+                except ValueError:
+                    # Not a row of this store, e.g. damaged by hand; its key is not marked as processed
+                    self.skipped += 1
+        self.missing_newline = bool(data) and not data.endswith(b'\n')
+
+    # Called before the first append, so new rows start on a line of their own: a damaged tail is moved to
+    # a side file, `<path>.damaged`, and a last row without its line ending gets one
+    def _repair(self):
+        if self.damaged_tail is not None:
+            with open(self.path, 'rb+') as file:
+                file.seek(self.damaged_tail)
+                with open(self.path + '.damaged', 'ab') as side_file:
+                    side_file.write(file.read())
+                file.truncate(self.damaged_tail)
+        elif self.missing_newline:
+            with open(self.path, 'ab') as file:
+                file.write(b'\n')
+        self.damaged_tail = None
+        self.missing_newline = False
+
+    def _convert(self, row):
+        for index, convert in self.types:
+            if index < len(row):
+                row[index] = convert(row[index]) if row[index] != '' else None
+        return row
+
+    def _add(self, row):
+        if len(row) != len(self.columns):
+            raise ValueError(f"Expected {len(self.columns)} values, got {len(row)}")
+        for column, value in zip(self.columns, row):
+            self.data[column].append(value)
+        self.keys.add(row[self.key_index])
+
+    def __contains__(self, key) -> bool:
+        return key in self.keys
+
+    def __len__(self) -> int:
+        return len(self.data[self.columns[0]])
+
+    def append(self, row):
+        with self.lock:
+            self._add(row)
+            self.pending.append(row)
+            if len(self.pending) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        self._repair()
+        write_header = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a', newline='') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            if write_header:
+                writer.writerow(self.columns)
+            writer.writerows(self.pending)
+        self.pending.clear()
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        with self.lock:
+            return pd.DataFrame({column: list(values) for column, values in self.data.items()})
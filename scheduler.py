@@ -0,0 +1,119 @@
+import time
+
+# What a task does when the tick has less time left than its budget
+SKIP: str = 'skip'  # Wait for its next period
+DEGRADE: str = 'degrade'  # Run the cheaper fallback instead
+ALWAYS: str = 'always'  # Run anyway, e.g. steering
+
+
+class Task:
+    # A callback, called with the tick number every `period` ticks, with a time budget in seconds
+    # and overrun statistics
+    __slots__ = ('name', 'callback', 'period', 'phase', 'budget', 'priority', 'policy', 'fallback',
+                 'runs', 'degraded', 'skipped', 'overruns', 'total_time', 'max_time')
+
+    def __init__(self, name: str, callback, period: int, budget: float, priority: int = 0, policy: str = SKIP,
+                 fallback=None, phase: int = 0):
+        if period < 1:
+            raise ValueError(f"Task period must be >= 1 tick, got {period}")
+        if policy not in (SKIP, DEGRADE, ALWAYS):
+            raise ValueError(f"Unknown overrun policy: {policy}")
+        if policy == DEGRADE and fallback is None:
+            raise ValueError(f"Task {name} degrades on overrun but has no fallback")
+        self.name = name
+        self.callback = callback
+        self.period = period
+        self.phase = phase % period
+        self.budget = budget
+        self.priority = priority
+        self.policy = policy
+        self.fallback = fallback
+
+        self.runs = 0  # Full runs
+        self.degraded = 0  # Fallback runs
+        self.skipped = 0
+        self.overruns = 0  # Runs that took longer than the budget
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def stats(self) -> dict:
+        executions = self.runs + self.degraded
+        return {
+            'period': self.period,
+            'budget_ms': self.budget * 1000,
+            'runs': self.runs,
+            'degraded': self.degraded,
+            'skipped': self.skipped,
+            'overruns': self.overruns,
+            'average_ms': self.total_time / executions * 1000 if executions else 0.0,
+            'max_ms': self.max_time * 1000,
+        }
+
+
+class Scheduler:
+    # Runs tasks at different rates within a fixed time budget per simulation tick. Due tasks run in order
+    # of priority (highest first); a task whose budget no longer fits in what is left of the tick is skipped
+    # or degraded according to its policy. Every execution is timed against the task's own budget.
+    def __init__(self, time_step: float, tick_budget: float | None = None):
+        self.time_step = time_step  # (in ms) basic time step of the simulation
+        self.tick_budget = (time_step if tick_budget is None else tick_budget) / 1000  # (in s)
+        self.tasks: list[Task] = []
+        self.ticks = 0
+        self.overrun_ticks = 0  # Ticks that ended after their deadline
+        self.clock = time.perf_counter
+
+    # interval and budget in ms; the interval is rounded down to a whole number of ticks, as the control loop
+    # did before, so a task never runs less often than asked, e.g. every 32 ms tick for a 50 ms interval
+    def add(self, name: str, callback, interval: float, budget: float, priority: int = 0, policy: str = SKIP,
+            fallback=None, phase: int = 0) -> Task:
+        if any(task.name == name for task in self.tasks):
+            raise ValueError(f"Task {name} is already registered")
+        period = max(1, int(interval // self.time_step))
+        task = Task(name, callback, period, budget / 1000, priority, policy, fallback, phase)
+        self.tasks.append(task)
+        self.tasks.sort(key=lambda t: -t.priority)  # Stable, so equal priorities keep their order
+        return task
+
+    # Runs the tasks due at `tick`. `started` is when the tick began (from the scheduler clock), so time spent
+    # before the scheduler, e.g. in the control step, counts against the tick budget.
+    def run(self, tick: int, started: float | None = None):
+        clock = self.clock
+        deadline = (clock() if started is None else started) + self.tick_budget
+
+        for task in self.tasks:
+            if tick % task.period != task.phase:
+                continue
+
+            callback = task.callback
+            if task.policy != ALWAYS and deadline - clock() < task.budget:
+                if task.policy == SKIP:
+                    task.skipped += 1
+                    continue
+                callback = task.fallback
+
+            start = clock()
+            try:
+                callback(tick)
+            finally:
+                elapsed = clock() - start
+                if callback is task.callback:
+                    task.runs += 1
+                else:
+                    task.degraded += 1
+                task.total_time += elapsed
+                if elapsed > task.max_time:
+                    task.max_time = elapsed
+                if elapsed > task.budget:
+                    task.overruns += 1
+
+        self.ticks += 1
+        if clock() > deadline:
+            self.overrun_ticks += 1
+
+    def stats(self) -> dict:
+        return {
+            'ticks': self.ticks,
+            'overrun_ticks': self.overrun_ticks,
+            'tick_budget_ms': self.tick_budget * 1000,
+            'tasks': {task.name: task.stats() for task in self.tasks},
+        }
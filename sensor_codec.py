@@ -0,0 +1,116 @@
+import struct
+
+import numpy as np
+
+# Binary envelope for sensor topics:
+#   magic (4s) | version (B) | dtype code (B) | ndim (B) | pad (x) | timestamp (d) | shape (ndim x I) | raw data
+# All fields and the data are little-endian, the data is the C-contiguous array buffer.
+MAGIC: bytes = b'AVSD'
+VERSION: int = 1
+
+HEADER = struct.Struct('<4sBBBxd')
+DIMENSION = struct.Struct('<I')
+
+DTYPES: dict[int, np.dtype] = {
+    1: np.dtype('<u1'),  # Camera images
+    2: np.dtype('<f4'),  # Lidar ranges and point clouds
+}
+DTYPE_CODES: dict[np.dtype, int] = {dtype: code for code, dtype in DTYPES.items()}
+
+
+def header_size(ndim: int) -> int:
+    return HEADER.size + DIMENSION.size * ndim
+
+
+def encode_header(array: np.ndarray, timestamp: float) -> bytes:
+    try:
+        code = DTYPE_CODES[array.dtype.newbyteorder('<')]
+    except KeyError:
+        raise ValueError(f"Unsupported dtype {array.dtype}, expected one of {list(DTYPE_CODES)}")
+    return HEADER.pack(MAGIC, VERSION, code, array.ndim, timestamp) + struct.pack(f'<{array.ndim}I', *array.shape)
+
+
+# Returns (header, data) without copying a contiguous little-endian array; useful when the transport
+# accepts several buffers. Other byte orders are converted, since the payload is always little-endian.
+def encode_parts(array: np.ndarray, timestamp: float):
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+    # A flat byte view, which also works for empty arrays, unlike memoryview.cast
+    return encode_header(array, timestamp), memoryview(array.reshape(-1).view(np.uint8))
+
+
+def encode(array: np.ndarray, timestamp: float) -> bytes:
+    header, data = encode_parts(array, timestamp)
+    return b''.join((header, data))
+
+
+# Zero-copy path: writes the envelope into a preallocated, reusable buffer and returns a read-only view of it
+def encode_into(buffer: bytearray, array: np.ndarray, timestamp: float) -> memoryview:
+    header = encode_header(array, timestamp)
+    size = len(header) + array.nbytes
+    if size > len(buffer):
+        raise ValueError(f"Buffer too small: {len(buffer)} bytes, {size} needed")
+
+    view = memoryview(buffer)
+    view[:len(header)] = header
+    # copyto converts the values when the array is not little-endian
+    payload = np.frombuffer(buffer, array.dtype.newbyteorder('<'), array.size, len(header))
+    np.copyto(payload.reshape(array.shape), array)
+    return view[:size].toreadonly()
+
+
+# Returns (timestamp, array); the array is a read-only view on the payload
+def decode(payload) -> tuple[float, np.ndarray]:
+    magic, version, code, ndim, timestamp = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise ValueError(f"Not a sensor payload (magic {magic!r})")
+    if version != VERSION:
+        raise ValueError(f"Unsupported sensor payload version {version}")
+
+    shape = struct.unpack_from(f'<{ndim}I', payload, HEADER.size)
+    dtype = DTYPES.get(code)
+    if dtype is None:
+        raise ValueError(f"Unknown dtype code {code} in sensor payload")
+    count = int(np.prod(shape))
+    array = np.frombuffer(payload, dtype, count, header_size(ndim)).reshape(shape)
+    return timestamp, array
+
+
+def benchmark_codec(repeats: int = 50):
+    import json
+    import time
+
+    rng = np.random.default_rng(0)
+    samples = {
+        "camera": rng.integers(0, 256, size=(128, 256, 4), dtype=np.uint8),
+        "lidar_range": rng.uniform(0.0, 80.0, 180).astype(np.float32),
+        "lidar_points": rng.uniform(-80.0, 80.0, (180, 5)).astype(np.float32),
+    }
+
+    # Format the publisher used before: repr of the data wrapped in a JSON envelope
+    def legacy(name, array):
+        if name == "camera":
+            data = str(array.tobytes())
+        elif name == "lidar_range":
+            data = str(array.tolist())
+        else:
+            data = str([{"x": x, "y": y, "z": z, "time": t, "layer": l} for x, y, z, t, l in array.tolist()])
+        return json.dumps({"channel": name, "data": {name: data}, "topic": name}).encode()
+
+    buffer = bytearray(1 << 20)
+    for name, array in samples.items():
+        timings = {}
+        for label, fn in (("legacy", lambda: legacy(name, array)),
+                          ("binary", lambda: encode(array, 1.0)),
+                          ("encode_into", lambda: encode_into(buffer, array, 1.0))):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                payload = fn()
+            timings[label] = ((time.perf_counter() - start) / repeats * 1e6, len(payload))
+
+        assert np.array_equal(decode(encode(array, 1.0))[1], array)
+        print(f"{name}: " + ", ".join(f"{label} {size} B in {us:.1f} us" for label, (us, size) in timings.items()))
+
+
+# For testing purposes
+if __name__ == '__main__':
+    benchmark_codec()
@@ -0,0 +1,88 @@
+from dataclasses import dataclass, field, fields, replace
+from threading import Lock
+
+
+@dataclass(frozen=True, slots=True)
+class Command:
+    # Latest control values requested through the API; version 0 is the initial command.
+    # field_versions holds the version of the command that last set each field, so the control loop
+    # only applies the fields sent since it last took a command and keeps its own values of the others.
+    speed: float
+    steering: float
+    brake: float
+    indicator: int
+    version: int = 0
+    field_versions: dict = field(default_factory=dict, compare=False)
+
+
+@dataclass(frozen=True, slots=True)
+class State:
+    # Vehicle state published by the control loop once per tick. Estimates that are unknown are None.
+    tick: int
+    speed: float  # Commanded values
+    steering: float
+    brake: float
+    indicator: str
+    current_speed: float  # Values read back from the driver
+    current_steering: float
+    current_brake: float
+    lane_angle: float | None = None
+    obstacle_angle: float | None = None
+    obstacle_distance: float | None = None
+    command_version: int = 0  # Version of the last command the control loop has taken
+
+    # All fields are scalars, so this is much cheaper than dataclasses.asdict, which deep-copies
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in STATE_FIELDS}
+
+
+STATE_FIELDS: tuple[str, ...] = tuple(field.name for field in fields(State))
+
+
+class SharedState:
+    # Hands commands from the API threads to the control loop and states back, as immutable snapshots.
+    # Each side fills a new snapshot and publishes it with a single reference assignment, which is atomic,
+    # so a reader sees either the previous or the next snapshot in full and never a torn update.
+    # Command writers are serialized by a lock because each command is built from the latest one.
+    # The control loop is the only reader of commands and the only writer of states, and never takes a lock.
+    def __init__(self, command: Command, state: State):
+        self._write_lock = Lock()
+        self._command = command
+        self._taken_version = command.version
+        self._state = state
+
+    # Publishes the latest command with the given fields changed; returns the new command
+    def publish_command(self, **changes) -> Command:
+        with self._write_lock:
+            version = self._command.version + 1
+            field_versions = {**self._command.field_versions, **dict.fromkeys(changes, version)}
+            command = replace(self._command, version=version, field_versions=field_versions, **changes)
+            self._command = command
+        return command
+
+    # Control loop only: returns the fields set by the commands published since the last call, with their
+    # latest values, or None if there were none. Fields no command has set since then are left out.
+    def take_command(self) -> dict | None:
+        command = self._command
+        taken_version = self._taken_version
+        if command.version == taken_version:
+            return None
+        self._taken_version = command.version
+        return {name: getattr(command, name)
+                for name, version in command.field_versions.items() if version > taken_version}
+
+    # Control loop only
+    def publish_state(self, state: State):
+        self._state = state
+
+    @property
+    def taken_version(self) -> int:
+        return self._taken_version
+
+    @property
+    def command(self) -> Command:
+        return self._command
+
+    @property
+    def state(self) -> State:
+        return self._state
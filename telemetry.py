@@ -0,0 +1,56 @@
+import json
+import threading
+
+
+class TelemetryBroadcaster:
+    # Fans the latest vehicle snapshot out to any number of streaming clients. The control loop only
+    # encodes each snapshot once and bumps a version; every subscriber waits on the condition on its
+    # own server thread and always sends the newest snapshot, skipping any it was too slow to send.
+    def __init__(self, max_subscribers: int = 32, keepalive: float = 15.0):
+        self.max_subscribers = max_subscribers
+        self.keepalive = keepalive  # (in s) comment line sent when no snapshot arrives, keeps proxies from timing out
+
+        self._condition = threading.Condition()
+        self._frame = None  # Latest snapshot encoded as a server-sent event
+        self._version = 0
+        self._closed = False
+        self.subscribers = 0
+
+    def publish(self, snapshot: dict):
+        frame = b'data: ' + json.dumps(snapshot, separators=(',', ':')).encode() + b'\n\n'
+        with self._condition:
+            self._frame = frame
+            self._version += 1
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def full(self) -> bool:
+        return self.subscribers >= self.max_subscribers
+
+    # Server-sent event stream for one subscriber. The subscriber is counted from the first read of the
+    # stream until it ends, so a client that disconnects before its stream starts never holds a slot.
+    # A stream that starts after the limit was reached ends at once.
+    def stream(self):
+        with self._condition:
+            if self.subscribers >= self.max_subscribers:
+                return
+            self.subscribers += 1
+        version = 0
+        try:
+            while True:
+                with self._condition:
+                    if not self._condition.wait_for(lambda: self._closed or self._version != version,
+                                                    self.keepalive):
+                        frame = b': keepalive\n\n'
+                    elif self._closed:
+                        return
+                    else:
+                        frame, version = self._frame, self._version
+                yield frame
+        finally:
+            with self._condition:
+                self.subscribers -= 1
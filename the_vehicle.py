@@ -2,11 +2,11 @@
 """the_vehicle controller."""
 import json
 import math
-import os
 
 from cv2 import Mat
 from numpy import uint8, array, ndarray
 
+from mlx.cache import PromptCache, VisionFeatureCache
 from mlx.generate import load_model, prepare_inputs, generate_text
 
 # You may need to import some classes of the controller module. Ex:
@@ -22,23 +22,53 @@ LLM_STEERING_DISABLED: bool = True
 # import math
 from controller import Camera, Lidar
 from vehicle import Driver
-from flask import (Flask)
-from threading import Thread
+from flask import (Flask, Response, jsonify, request)
+from threading import Lock, Thread
 from publisher import Publisher
+from inference_worker import InferenceWorker
+from telemetry import TelemetryBroadcaster
+from shared_state import Command, SharedState, State
+from scheduler import Scheduler, DEGRADE, ALWAYS
+from perception import UNKNOWN
+import perception
+import filters
 import cv2
 # import PIL.Image as Image
 import numpy as np
 
 PORT = 5300
 HOST = '0.0.0.0'
-DEBUG = True
+DEBUG = False  # Only used when falling back to Flask's development server
 USE_RELOADER = False
+USE_WAITRESS: bool = True  # Serve the API with waitress when it is installed
+SERVER_THREADS: int = 8  # Worker threads of the API server, not counting telemetry streams
+TELEMETRY_MAX_SUBSCRIBERS: int = 32  # Each open /telemetry stream holds one server thread
 
 TIME_STEP: int = 50  # (in ms) / Specify the time step of the simulation
 KAFKA_SERVER: str = 'localhost:39093'  # Kafka server address
+KAFKA_ASYNC_PUBLISHING: bool = True  # Batch messages instead of flushing after every one
 
-UNKNOWN: float = 99999.99  # Unknown value for Lidar data
 FILTER_SIZE: int = 3  # Size of the filter for Camera data
+FILTER_KIND: str = filters.MEAN  # Filter for Camera data: filters.MEAN, filters.MEDIAN or filters.EXPONENTIAL
+
+#  Lane detection (defaults scan the full frame)
+LANE_ROI: tuple[float, float] = (0.0, 1.0)  # (top, bottom) band of the image height searched for the line
+LANE_ROW_STRIDE: int = 1  # Only every n-th row of the band is checked
+LANE_COLUMN_STRIDE: int = 1  # Only every n-th column of the band is checked
+LANE_ADAPTIVE_WINDOW: float | None = None  # Half width (fraction of image width) searched around the last line position
+DEGRADED_LANE_STRIDE: int = 4  # Row and column strides are multiplied by this when lane detection runs degraded
+
+#  Scheduling of the control loop tasks, (interval, budget) in ms. Tasks that no longer fit in the
+#  remaining time of a simulation step are skipped, or degraded if they have a cheaper fallback.
+AUTO_STEER_START: int = 200  # Step from which auto steering runs
+LANE_TASK: tuple[float, float] = (TIME_STEP, 5.0)
+LIDAR_TASK: tuple[float, float] = (TIME_STEP, 2.0)
+STEER_TASK: tuple[float, float] = (TIME_STEP, 1.0)
+PUBLISH_SENSOR_DATA: bool = False  # Publish camera and lidar data to Kafka
+PUBLISH_TASK: tuple[float, float] = (TIME_STEP, 5.0)
+LLM_ANNOTATION: bool = False  # Periodically hand a camera frame to the LLM
+LLM_TASK: tuple[float, float] = (1000, 5.0)
+GUI_TASK: tuple[float, float] = (100, 2.0)
 
 #  Definition of Sensor Names
 CAMERA_NAME: str = "camera"
@@ -59,22 +89,28 @@ Kp = 0.25
 Ki = 0.006
 Kd = 2
 
-processor, model = load_model("llava-hf/llava-1.5-7b-hf")
+# Near-duplicate camera frames reuse the projected image features of a previous frame
+VISION_CACHE_THRESHOLD: float = 0.05  # Max mean abs difference of the pooled, normalized pixel values
+VISION_CACHE_SIZE: int = 16
+
+LLAVA_MODEL: str = "llava-hf/llava-1.5-7b-hf"
+processor, model = None, None  # Loaded by get_model() on first use
+prompt_cache = None  # Key/value state of the text before the image in `prompt`, created by get_model()
+model_lock = Lock()
 max_tokens, temperature = 128, 0.0
 prompt = "USER: <image>\nWhat are these?\nASSISTANT:"
 
 
-def color_diff(a, b):
-    diff = 0
-    for i in range(3):
-        d = a[i] - b[i]
-        if d > 0:
-            diff += d
-        else:
-            diff -= d
-
-    # print(diff)
-    return diff
+# Loads the model the first time an inference needs it, which happens on the inference worker
+# thread, so the controller starts stepping the simulation straight away
+def get_model():
+    global processor, model, prompt_cache
+    with model_lock:
+        if model is None:
+            processor, model = load_model(LLAVA_MODEL)
+            model.feature_cache = VisionFeatureCache(VISION_CACHE_THRESHOLD, VISION_CACHE_SIZE)
+            prompt_cache = PromptCache()
+    return processor, model
 
 
 class Vehicle:
@@ -82,6 +118,7 @@ class Vehicle:
     INDICATOR_OFF: int = 0
     INDICATOR_RIGHT: int = 1
     INDICATOR_LEFT: int = 2
+    INDICATOR_NAMES: dict[int, str] = {INDICATOR_OFF: 'Off', INDICATOR_RIGHT: 'Right', INDICATOR_LEFT: 'Left'}
 
     def __init__(self, driver: Driver, publisher: Publisher):
         self.driver: Driver = driver
@@ -91,14 +128,29 @@ class Vehicle:
         self.indicator: int = 0
         self.brake_intensity: float = 0.0
 
-        self.first_call = True
-        self.old_value = [0.0 for i in range(FILTER_SIZE)]
+        # Latest estimates of auto_steer, streamed as telemetry
+        self.lane_angle: float = UNKNOWN
+        self.obstacle_angle: float = UNKNOWN
+        self.obstacle_distance: float = UNKNOWN
+        self.telemetry = TelemetryBroadcaster(TELEMETRY_MAX_SUBSCRIBERS)
+        self.scheduler: Scheduler | None = None  # Set by run_server before the API starts, serves its statistics
+
+        # The API threads only publish commands and read states here; the fields above are owned by the
+        # control loop, which takes each command once per tick and publishes the resulting state
+        self.shared = SharedState(
+            Command(self.speed, self.steering_angle, self.brake_intensity, self.indicator),
+            State(-1, self.speed, self.steering_angle, self.brake_intensity, self.INDICATOR_NAMES[self.indicator],
+                  self.speed, self.steering_angle, self.brake_intensity)
+        )
 
-        self.pid_needs_reset = False
-        self.integral = 0.0
-        self.old_value_pid = 0.0
+        self.angle_filter = filters.create_filter(FILTER_KIND, FILTER_SIZE)
+        self.pid = filters.PIDController(Kp, Ki, Kd)
 
         self.image = None
+        self.llm_suggestion: str | None = None
+        self.llm_suggestion_age: float | None = None  # (in s) since the frame behind the suggestion was captured
+        self.inference_worker = InferenceWorker(self.annotate_frame, name="llava-worker")
+
         self.camera = self.driver.getDevice(CAMERA_NAME)
         if self.camera:
             self.camera: Camera = Camera(CAMERA_NAME)
@@ -108,6 +160,17 @@ class Vehicle:
             self.camera_height = self.camera.getHeight()
             self.camera_fov = self.camera.getFov()
 
+            self.lane_detector = perception.LaneDetector(
+                self.camera_width, self.camera_height, self.camera_fov, roi=LANE_ROI,
+                row_stride=LANE_ROW_STRIDE, column_stride=LANE_COLUMN_STRIDE, adaptive_window=LANE_ADAPTIVE_WINDOW
+            )
+            # Cheaper detector used when the lane task runs degraded
+            self.coarse_lane_detector = perception.LaneDetector(
+                self.camera_width, self.camera_height, self.camera_fov, roi=LANE_ROI,
+                row_stride=LANE_ROW_STRIDE * DEGRADED_LANE_STRIDE,
+                column_stride=LANE_COLUMN_STRIDE * DEGRADED_LANE_STRIDE, adaptive_window=LANE_ADAPTIVE_WINDOW
+            )
+
         else:
             print("Camera not found")
 
@@ -115,6 +178,8 @@ class Vehicle:
         self.lidar_width: int = -1
         self.lidar_range: float = -1.0
         self.lidar_fov: float = -1.0
+        self.lidar_scan: list[float] | None = None  # Range image of the last detect_obstacle()
+        self._lidar_analysis: perception.LidarScanAnalysis | None = None
         if self.lidar:
             self.lidar: Lidar = Lidar(LIDAR_NAME)
             self.lidar.enable(TIME_STEP)
@@ -132,19 +197,17 @@ class Vehicle:
 
         @api.route('/stop')
         def stop():
-            self.speed = 0.0
-            self.steering_angle = 0.0
+            self.shared.publish_command(speed=0.0, steering=0.0)
             return 'stopped'
 
         @api.route('/start')
         def start():
-            self.speed = 2.0
+            self.shared.publish_command(speed=2.0)
             return 'started'
 
         @api.route('/getSteeringAngle')  # GET /getSteeringAngle
         def get_steering_angle():
-            self.steering_angle = self.driver.getSteeringAngle()
-            return str(self.steering_angle)
+            return str(self.shared.state.current_steering)
 
         @api.route('/setSteeringAngle/<angle>')  # GET /setSteeringAngle/0.5
         def set_steering_angle(angle: float = 0.0):
@@ -161,13 +224,12 @@ class Vehicle:
             # elif angle < MIN_STEERING_ANGLE:
             #     angle = MIN_STEERING_ANGLE
 
-            self.steering_angle = float(angle)
+            self.shared.publish_command(steering=float(angle))
             return 'Steering angle set to' + str(angle)
 
         @api.route('/getBrakeIntensity')  # GET /getBrakeIntensity
         def get_brake_intensity():
-            self.brake_intensity = self.driver.getBrakeIntensity()
-            return str(self.brake_intensity)
+            return str(self.shared.state.current_brake)
 
         @api.route('/setBrakeIntensity/<intensity>')  # GET /setBrakeIntensity/0.5
         def set_brake_intensity(intensity: float = 0.0):
@@ -178,57 +240,154 @@ class Vehicle:
             elif intensity < 0:
                 intensity = 0
 
-            self.brake_intensity = float(intensity)
+            self.shared.publish_command(brake=float(intensity))
             return 'Brake intensity set to' + str(intensity)
 
         @api.route('/getSpeed')  # GET /getSpeed
         def get_speed():
-            self.speed = self.driver.getCurrentSpeed()
-            return str(self.speed)
+            return str(self.shared.state.current_speed)
 
         @api.route('/setSpeed/<speed>')  # GET /setSpeed/2
         def set_speed(speed: float = 0):
             speed = float(speed)
             # Limit the speed to the range of 0 to MAX_SPEED
             if speed > MAX_SPEED:
-                self.speed = MAX_SPEED  # Max Speed
+                self.shared.publish_command(speed=MAX_SPEED)  # Max Speed
             elif speed < 0:
-                self.speed = 0.0
+                self.shared.publish_command(speed=0.0)
             else:
-                self.speed = float(speed)
+                self.shared.publish_command(speed=float(speed))
             return 'Speed set to' + str(speed)
 
         @api.route('/getIndicator')  # GET /getIndicator
         def get_indicator():
-            match self.indicator:
-                case self.INDICATOR_OFF:
-                    return 'Off'
-                case self.INDICATOR_RIGHT:
-                    return 'Right'
-                case self.INDICATOR_LEFT:
-                    return 'Left'
-                case _:
-                    # Reset to Off
-                    self.indicator = self.INDICATOR_OFF
-                    return 'Off'
+            return self.shared.state.indicator
 
         @api.route('/setIndicatorOff')  # GET /setIndicatorOff
         def set_indicator_off():
-            self.indicator = self.INDICATOR_OFF
+            self.shared.publish_command(indicator=self.INDICATOR_OFF)
             return 'Indicator set to Off'
 
         @api.route('/setIndicatorRight')  # GET /setIndicatorRight
         def set_indicator_right():
-            self.indicator = self.INDICATOR_RIGHT
+            self.shared.publish_command(indicator=self.INDICATOR_RIGHT)
             return 'Indicator set to Right'
 
         @api.route('/setIndicatorLeft')  # GET /setIndicatorLeft
         def set_indicator_left():
-            self.indicator = self.INDICATOR_LEFT
+            self.shared.publish_command(indicator=self.INDICATOR_LEFT)
             return 'Indicator set to Left'
 
+        # POST /command {"speed": 10, "steering": 0.1, "brake": 0, "indicator": "left"}
+        # Any subset of the fields can be given, the others are left to the control loop; returns the last
+        # published state with the fields sent
+        @api.route('/command', methods=['POST'])
+        def command():
+            body = request.get_json(silent=True)
+            try:
+                return jsonify(self.apply_command(body))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+        @api.route('/state')  # GET /state
+        def state():
+            return jsonify(self.get_state())
+
+        @api.route('/schedulerStats')  # GET /schedulerStats
+        def scheduler_stats():
+            if self.scheduler is None:
+                return jsonify({'error': 'The control loop is not running'}), 503
+            return jsonify(self.scheduler.stats())
+
+        # GET /telemetry, server-sent events with one snapshot per control tick
+        @api.route('/telemetry')
+        def telemetry():
+            if self.telemetry.full():
+                return jsonify({'error': 'Too many telemetry subscribers'}), 503
+            return Response(self.telemetry.stream(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
         return api
 
+    # Validates the whole command first, then publishes it for the control loop as one snapshot
+    def apply_command(self, command) -> dict:
+        if not isinstance(command, dict):
+            raise ValueError("Command must be a JSON object")
+        unknown = set(command) - {'speed', 'steering', 'brake', 'indicator'}
+        if unknown:
+            raise ValueError(f"Unknown command fields: {', '.join(sorted(unknown))}")
+
+        values = {}
+        try:
+            if 'speed' in command:
+                values['speed'] = min(max(float(command['speed']), 0.0), MAX_SPEED)
+            if 'steering' in command:
+                values['steering'] = float(command['steering'])
+            if 'brake' in command:
+                values['brake'] = min(max(float(command['brake']), 0.0), MAX_BRAKE_INTENSITY)
+        except (TypeError, ValueError):
+            raise ValueError("speed, steering and brake must be numbers")
+        if not all(math.isfinite(value) for value in values.values()):
+            raise ValueError("speed, steering and brake must be finite")
+        if 'indicator' in command:
+            values['indicator'] = self.parse_indicator(command['indicator'])
+
+        command = self.shared.publish_command(**values)
+        state = self.get_state()
+        state.update(values, command_version=command.version)
+        if 'indicator' in values:
+            state['indicator'] = self.INDICATOR_NAMES[values['indicator']]
+        return state
+
+    def parse_indicator(self, indicator) -> int:
+        if isinstance(indicator, str):
+            for value, name in self.INDICATOR_NAMES.items():
+                if indicator.lower() == name.lower():
+                    return value
+        elif indicator in self.INDICATOR_NAMES and not isinstance(indicator, bool):
+            return int(indicator)
+        raise ValueError(f"indicator must be one of {', '.join(self.INDICATOR_NAMES.values())}")
+
+    # Last state published by the control loop, never touches the driver
+    def get_state(self) -> dict:
+        return self.shared.state.as_dict()
+
+    # Control loop: applies the latest command if there is a new one
+    def take_command(self):
+        changes = self.shared.take_command()
+        if changes is None:
+            return
+        # Only the fields the API has set, the others keep the values of the control loop
+        if 'speed' in changes:
+            self.speed = changes['speed']
+        if 'steering' in changes:
+            self.steering_angle = changes['steering']
+        if 'brake' in changes:
+            self.brake_intensity = changes['brake']
+        if 'indicator' in changes:
+            self.indicator = changes['indicator']
+
+    # Called once per control tick on the simulation thread, the only thread that reads the driver
+    def publish_state(self, time_step: int):
+        state = State(
+            time_step,
+            self.speed,
+            self.steering_angle,
+            self.brake_intensity,
+            self.INDICATOR_NAMES.get(self.indicator, 'Off'),
+            self.driver.getCurrentSpeed(),
+            self.driver.getSteeringAngle(),
+            self.driver.getBrakeIntensity(),
+            # Unknown estimates are published as None
+            None if self.lane_angle == UNKNOWN else self.lane_angle,
+            None if self.obstacle_angle == UNKNOWN else self.obstacle_angle,
+            None if self.obstacle_distance == UNKNOWN else self.obstacle_distance,
+            self.shared.taken_version,
+        )
+        self.shared.publish_state(state)
+        if self.telemetry.subscribers:
+            self.telemetry.publish(state.as_dict())
+
     def adjust_speed(self):
         self.driver.setCruisingSpeed(self.speed)
 
@@ -254,79 +413,26 @@ class Vehicle:
         self.driver.setBrakeIntensity(self.brake_intensity)
 
     def apply_pid(self, angle):
-        if self.pid_needs_reset:
-            self.pid_needs_reset = False
-            self.old_value_pid = angle
-            self.integral = 0.0
-
-        if angle != self.old_value_pid:
-            self.integral = 0.0
-
-        diff = angle - self.old_value_pid
-
-        if self.integral < 30 and self.integral > -30:
-            self.integral += angle
-
-        self.old_value_pid = angle
-        print(f"Angle: {angle}, Old Value: {self.old_value_pid}, Diff: {diff}")
-        return Kp * angle + Ki * self.integral + Kd * diff
+        steer = self.pid.update(angle)
+        print(f"Angle: {angle}, Integral: {self.pid.integral}, Steer: {steer}")
+        return steer
 
     def filter_angle(self, new_value):
-
-        if self.first_call | (new_value == UNKNOWN):
-            self.first_call = False
-            for i in range(FILTER_SIZE):
-                self.old_value[i] = 0.0
-        else:
-            for i in range(FILTER_SIZE - 1):
-                self.old_value[i] = self.old_value[i + 1]
-
         if new_value == UNKNOWN:
+            self.angle_filter.reset()
             return UNKNOWN
-        else:
-            self.old_value[FILTER_SIZE - 1] = new_value
-            sum = 0.0
-            for i in range(FILTER_SIZE):
-                sum += self.old_value[i]
-            return sum / FILTER_SIZE
+        return self.angle_filter.update(new_value)
 
     def process_camera_image(self, image: bytes):
-        num_pixels = self.camera_width * self.camera_height
-        ref = [95, 187, 203]
-        sum_of_x = 0
-        pixel_count = 0
-        pixel = 0
-
-        for x in range(num_pixels):
-            pixel = image[x * 4: x * 4 + 3]  # Extract BGR values from image
-            if color_diff(pixel, ref) < 30:
-                sum_of_x += x % self.camera_width
-                pixel_count += 1
-
-        if pixel_count == 0:
-            return UNKNOWN
-
-        return ((sum_of_x / pixel_count / self.camera_width) - 0.5) * self.camera_fov
+        return self.lane_detector.detect(image)
 
     # Returns approximate (angle, distance) of obstacle
     def process_sick_lidar(self, lidar_data: list[float]):
-        HALF_AREA = 20  # Check 20 degrees to the left and right of the vehicle
-        sum_of_x = 0
-        collision_count = 0
-        obstacle_distance = 0.0
-
-        for x in range(round(self.lidar_width / 2 - HALF_AREA), round(self.lidar_width / 2 + HALF_AREA)):
-            if lidar_data[x] < 20.0:
-                sum_of_x += x
-                collision_count += 1
-                obstacle_distance += lidar_data[x]
-
-        if collision_count == 0:
-            return UNKNOWN, obstacle_distance
-
-        obstacle_distance /= collision_count
+        return perception.process_sick_lidar(lidar_data, self.lidar_width, self.lidar_fov)
 
-        return (sum_of_x / collision_count / self.lidar_width - 0.5) * self.lidar_fov, obstacle_distance
+    # Returns per-sector distances, obstacle clusters and free space of the whole scan
+    def analyze_sick_lidar(self, lidar_data: list[float]) -> perception.LidarScanAnalysis:
+        return perception.analyze_lidar_scan(lidar_data, self.lidar_fov)
 
     def get_and_publish_camera_data(self, time_step: int):
         if self.camera:
@@ -343,20 +449,41 @@ class Vehicle:
             )
             # cv2.imshow(CAMERA_NAME, self.image)
 
-            # self.publisher.publish_camera_data(time_step, camera_image)
+            if PUBLISH_SENSOR_DATA:
+                self.publisher.publish_camera_data(time_step, self.image)
 
     def get_and_publish_lidar_data(self, time_step: int):
         if self.lidar:
             scan = self.lidar.getRangeImage()
-            point_cloud_data = self.lidar.getPointCloud()
-            # self.publisher.publish_lidar_data(time_step, point_cloud_data, scan)
-
-    def auto_steer(self, enable_collision_avoidance, i):
-        camera_image = self.camera.getImage()
-        sick_data = self.lidar.getRangeImage()
-        yellow_line_angle = self.filter_angle(self.process_camera_image(camera_image))
-
-        obstacle_angle, obstacle_dist = self.process_sick_lidar(sick_data)  # Returns (angle, distance)
+            point_cloud_data = self.lidar.getPointCloud(data_type='buffer')
+            if PUBLISH_SENSOR_DATA:
+                self.publisher.publish_lidar_data(time_step, point_cloud_data, scan)
+
+    # Updates the filtered yellow line angle; degraded runs scan a coarser grid of the image
+    def detect_lane(self, degraded: bool = False):
+        detector = self.coarse_lane_detector if degraded else self.lane_detector
+        self.lane_angle = self.filter_angle(detector.detect(self.camera.getImage()))
+
+    # Only the obstacle in front is computed every tick, the full scan analysis is left to lidar_analysis
+    def detect_obstacle(self):
+        self.lidar_scan = self.lidar.getRangeImage()
+        self._lidar_analysis = None
+        self.obstacle_angle, self.obstacle_distance = self.process_sick_lidar(self.lidar_scan)  # (angle, distance)
+
+    # Analysis of the last scan, computed on first access so the control loop does not pay for it
+    @property
+    def lidar_analysis(self) -> perception.LidarScanAnalysis | None:
+        if self._lidar_analysis is None and self.lidar_scan is not None:
+            self._lidar_analysis = self.analyze_sick_lidar(self.lidar_scan)
+        return self._lidar_analysis
+
+    # With detect=False the latest lane and obstacle estimates are used, e.g. when the scheduler updates them
+    def auto_steer(self, enable_collision_avoidance, i, detect: bool = True):
+        if detect:
+            self.detect_lane()
+            self.detect_obstacle()
+        yellow_line_angle = self.lane_angle
+        obstacle_angle, obstacle_dist = self.obstacle_angle, self.obstacle_distance
 
         # print(f"Yellow Line Angle: {yellow_line_angle}")
         # print(f"Obstacle Angle: {obstacle_angle}")
@@ -379,7 +506,7 @@ class Vehicle:
                 elif obstacle_steering < 0 and line_following_steering < 0:
                     steer = min(obstacle_steering, line_following_steering)
             else:
-                self.pid_needs_reset = True
+                self.pid.reset()
             self.steering_angle = steer
             self.adjust_steering_angle()
             # print("yellow line angle: %f, obstacle angle: %f, obstacle dist: %f, obstacle steering: %f, steer: %f\n" %
@@ -396,7 +523,7 @@ class Vehicle:
         elif enable_collision_avoidance:
             # No obstacle has been detected but the line is lost => brake and hope to find the line again
             self.brake_intensity = 0.4
-            self.pid_needs_reset = True
+            self.pid.reset()
             print("Lost the line")
 
         if obstacle_angle != UNKNOWN:  # will always publish data if obstacle exists
@@ -413,27 +540,35 @@ class Vehicle:
 
         # print(f"Steering Angle: {self.steering_angle}")
 
-    def llm_annotate_image(self, ):
-        image_location = "image.jpg"
+    # Runs on the inference worker thread
+    def annotate_frame(self, frame: ndarray):
+        processor, model = get_model()
+        input_ids, pixel_values = prepare_inputs(processor, frame, prompt)
 
-        self.camera.saveImage(image_location, 100)
+        # The prompt is the same for every frame, so only the image and the text after it are prefilled
+        reply = generate_text(
+            input_ids, pixel_values, model, processor, max_tokens, temperature, prompt_cache
+        )
+        print(reply)
+        return reply
 
+    # Never blocks on the model: queues the current frame and picks up the most recent finished reply
+    def llm_annotate_image(self, ):
         self.image = np.frombuffer(self.camera.getImage(), np.uint8).reshape(
             (self.camera.getHeight(), self.camera.getWidth(), 4)
         )
         cv2.imshow(CAMERA_NAME, self.image)
 
-        input_ids, pixel_values = prepare_inputs(processor, image_location, prompt)
-
-        reply = generate_text(
-            input_ids, pixel_values, model, processor, max_tokens, temperature
-        )
-        print(reply)
+        # Copy, the camera reuses its buffer on the next step
+        self.inference_worker.start()
+        self.inference_worker.submit(self.image.copy())
 
-        #Delete the saved image after processing
-        os.remove("image.jpg")
+        self.llm_suggestion, self.llm_suggestion_age = self.inference_worker.latest()
+        return self.llm_suggestion
 
     def __del__(self):
+        self.telemetry.close()
+        self.inference_worker.stop(timeout=1.0)
         if self.camera:
             self.camera.disable()
         if self.lidar:
@@ -441,10 +576,60 @@ class Vehicle:
         self.driver.__del__()
 
 
+# Serves the API with waitress if available, otherwise with Flask's threaded development server
+def serve_app(app):
+    if USE_WAITRESS:
+        try:
+            from waitress import serve
+        except ImportError:
+            print("waitress not installed, falling back to the Flask server")
+        else:
+            serve(app, host=HOST, port=PORT, threads=SERVER_THREADS + TELEMETRY_MAX_SUBSCRIBERS)
+            return
+    app.run(host=HOST, port=PORT, debug=DEBUG, use_reloader=USE_RELOADER, threaded=True)
+
+
+# Registers the work of the control loop besides the control step itself, which runs on every step
+def create_scheduler(vehicle: Vehicle, time_step: float) -> Scheduler:
+    scheduler = Scheduler(time_step)
+
+    if PROGRAM_MODE == AUTO_MODE:
+        def detect_lane(tick):
+            if tick > AUTO_STEER_START:
+                vehicle.detect_lane()
+
+        def detect_lane_degraded(tick):
+            if tick > AUTO_STEER_START:
+                vehicle.detect_lane(degraded=True)
+
+        def detect_obstacle(tick):
+            if tick > AUTO_STEER_START:
+                vehicle.detect_obstacle()
+
+        def steer(tick):
+            if tick > AUTO_STEER_START:
+                vehicle.auto_steer(LLM_STEERING_DISABLED, tick, detect=False)
+
+        # Steering must see fresh lidar data, only lane detection may fall back to a coarser scan
+        scheduler.add('lane', detect_lane, *LANE_TASK, priority=3, policy=DEGRADE, fallback=detect_lane_degraded)
+        scheduler.add('lidar', detect_obstacle, *LIDAR_TASK, priority=3, policy=ALWAYS)
+        scheduler.add('steer', steer, *STEER_TASK, priority=2, policy=ALWAYS)
+    if PUBLISH_SENSOR_DATA:
+        scheduler.add('publish_camera', vehicle.get_and_publish_camera_data, *PUBLISH_TASK, priority=1)
+        scheduler.add('publish_lidar', vehicle.get_and_publish_lidar_data, *PUBLISH_TASK, priority=1)
+    if LLM_ANNOTATION:
+        scheduler.add('llm', lambda tick: vehicle.llm_annotate_image(), *LLM_TASK, priority=0)
+    scheduler.add('gui', lambda tick: cv2.waitKey(1), *GUI_TASK, priority=-1)
+    return scheduler
+
+
 def run_server():
     driver: Driver = Driver()
-    publisher: Publisher = Publisher(KAFKA_SERVER)
+    publisher: Publisher = Publisher(KAFKA_SERVER, asynchronous=KAFKA_ASYNC_PUBLISHING)
     vehicle: Vehicle = Vehicle(driver, publisher)
+    current_time_step: float = driver.getBasicTimeStep()
+    scheduler = create_scheduler(vehicle, current_time_step)
+    vehicle.scheduler = scheduler
     app = vehicle.create_app()
 
     cv2.startWindowThread()
@@ -453,40 +638,28 @@ def run_server():
     driver.step()  # Start the driver and make the first step
 
     #  Start the server in a separate thread
-    server_thread = Thread(target=app.run, kwargs={
-        'host': HOST, 'port': PORT, 'debug': DEBUG, 'use_reloader': USE_RELOADER
-    })
+    server_thread = Thread(target=serve_app, args=(app,), daemon=True)
     server_thread.start()
 
     i: int = 0  # TimeStep counter
     line_counter: int = 0  # Line counter
-    current_time_step: float = driver.getBasicTimeStep()
     cv2.resizeWindow(CAMERA_NAME, vehicle.camera.getWidth() * 2, vehicle.camera.getHeight() * 2)
     while driver.step() != -1:
-        # if i > 200:
-        #     vehicle.auto_steer(LLM_STEERING_DISABLED, i)
+        started = scheduler.clock()
+        vehicle.take_command()
         vehicle.adjust_brake_intensity()
         vehicle.adjust_speed()
         vehicle.adjust_steering_angle()
 
-        #  Publish camera and lidar data on every TimeStep ms
-        if (i % int(TIME_STEP / current_time_step)) == 0:
-            if i > 200:
-                if PROGRAM_MODE == AUTO_MODE:
-                    vehicle.auto_steer(LLM_STEERING_DISABLED, i)
-            # vehicle.llm_annotate_image()
-
-            # print(filter_angle(vehicle.process_camera_image()))
-            # vehicle.get_and_publish_camera_data(i)
-            # vehicle.get_and_publish_lidar_data(i)
-            # print(f"Published camera and lidar data at {i} ms")
-            # print(vehicle.camera.getImageArray())
-            pass
+        #  Lane and obstacle detection, steering, publishing, LLM and GUI at their own rates
+        scheduler.run(i, started)
 
-        cv2.waitKey(1)
+        vehicle.publish_state(i)  # Snapshot for the API getters and the /telemetry streams
 
         i += 1  # Increment TimeStep counter
 
+    print(scheduler.stats())
+    publisher.close()  # Bounded flush of the messages still queued
     vehicle.__del__()  # Cleanup
 
 